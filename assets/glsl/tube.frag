@@ -6,12 +6,28 @@
     #define MAX_LIGHTS 0
 #endif
 
+// The normal map and the specular reflection fade out as fog and occlusion
+// darken fragments from the fade alpha down to the LOD alpha, below which they
+// are skipped, and below the cull alpha, all shading is
+#ifndef SHADING_LOD_FADE_ALPHA
+    #define SHADING_LOD_FADE_ALPHA 0.08
+#endif
+#ifndef SHADING_LOD_ALPHA
+    #define SHADING_LOD_ALPHA 0.02
+#endif
+#ifndef SHADING_CULL_ALPHA
+    #define SHADING_CULL_ALPHA 1e-6
+#endif
+
 #ifdef USE_330
     #define texture2D texture
+    #define texture2DLod textureLod
+    #define texture2DGrad textureGrad
     #define textureCube texture
     #define textureCubeLod textureLod
 #else
     #extension GL_ARB_shader_texture_lod : require
+    #define texture2DGrad texture2DGradARB
 #endif
 
 uniform struct p3d_MaterialParameters {
@@ -108,8 +124,8 @@ float diffuse_function() {
     return 1.0 / PI;
 }
 
-vec3 get_normalmap_data() {
-    return 2.0 * texture2D(p3d_TextureNormal, v_texcoord).rgb - 1.0;
+vec3 get_normalmap_data(vec2 uv_dx, vec2 uv_dy) {
+    return 2.0 * texture2DGrad(p3d_TextureNormal, v_texcoord, uv_dx, uv_dy).rgb - 1.0;
 }
 
 vec3 irradiance_from_sh(vec3 normal) {
@@ -126,22 +142,52 @@ vec3 irradiance_from_sh(vec3 normal) {
 }
 
 void main() {
-    vec4 metal_rough = texture2D(p3d_TextureSelector, v_texcoord);
+    //float ambient_occlusion = metal_rough.r;
+    float ambient_occlusion = 1.0;
+    ambient_occlusion *= v_color.a;
+
+    // The lookups below are behind branches that differ between neighbouring
+    // fragments, so they take their derivatives from here
+    vec2 uv_dx = dFdx(v_texcoord);
+    vec2 uv_dy = dFdy(v_texcoord);
+    vec4 base_texel = texture2D(p3d_TextureFF, v_texcoord);
+
+    if (ambient_occlusion < SHADING_CULL_ALPHA) {
+        // Lost in the fog; not worth the other texture lookups, but the alpha
+        // has to be the same as base_color's below
+        float alpha = (p3d_Material.baseColor * p3d_ColorScale * (base_texel + p3d_TexAlphaOnly)).a;
+#ifdef USE_330
+        o_color = vec4(0.0, 0.0, 0.0, alpha);
+#else
+        gl_FragColor = vec4(0.0, 0.0, 0.0, alpha);
+#endif
+        return;
+    }
+    float detail = smoothstep(SHADING_LOD_ALPHA, SHADING_LOD_FADE_ALPHA, ambient_occlusion);
+
+    vec4 metal_rough = texture2DGrad(p3d_TextureSelector, v_texcoord, uv_dx, uv_dy);
     float metallic = clamp(p3d_Material.metallic * metal_rough.b, 0.0, 1.0);
     float perceptual_roughness = clamp(p3d_Material.roughness * metal_rough.g,  0.0, 1.0);
     float alpha_roughness = perceptual_roughness * perceptual_roughness;
-    vec4 base_color = p3d_Material.baseColor * vec4(v_color.rgb, 1) * p3d_ColorScale * (texture2D(p3d_TextureFF, v_texcoord) + p3d_TexAlphaOnly);
+    vec4 base_color = p3d_Material.baseColor * vec4(v_color.rgb, 1) * p3d_ColorScale * (base_texel + p3d_TexAlphaOnly);
     vec3 diffuse_color = (base_color.rgb * (vec3(1.0) - F0)) * (1.0 - metallic);
     vec3 spec_color = mix(F0, base_color.rgb, metallic);
-    vec3 normalmap = get_normalmap_data();
+#ifdef USE_NORMAL_MAP
+    vec3 normalmap = vec3(0.0, 0.0, 1.0);
+    if (detail > 0.0) {
+        normalmap = mix(normalmap, get_normalmap_data(uv_dx, uv_dy), detail);
+    }
     vec3 n = normalize(v_world_tbn * normalmap);
+#else
+    vec3 n = normalize(v_world_tbn[2]);
+#endif
     vec3 v = normalize(camera_world_position - v_world_position);
 
-    //float ambient_occlusion = metal_rough.r;
-    float ambient_occlusion = 1.0;
-    ambient_occlusion *= v_color.a;
-
-    vec3 emission = p3d_Material.emission.rgb * texture2D(p3d_TextureEmission, v_texcoord).rgb;
+#ifdef USE_EMISSION_MAP
+    vec3 emission = p3d_Material.emission.rgb * texture2DGrad(p3d_TextureEmission, v_texcoord, uv_dx, uv_dy).rgb;
+#else
+    vec3 emission = vec3(0.0);
+#endif
 
     vec4 color = vec4(vec3(0.0), base_color.a);
 
@@ -152,11 +198,15 @@ void main() {
     vec3 ibl_kd = (1.0 - ibl_f) * (1.0 - metallic);
     vec3 ibl_diff = base_color.rgb * max(irradiance_from_sh(n), 0.0) * diffuse_function();
 
-    vec3 ibl_r = reflect(-v, n);
-    vec2 env_brdf = texture2D(brdf_lut, vec2(n_dot_v, perceptual_roughness)).rg;
-    vec3 ibl_spec_color = textureCubeLod(filtered_env_map, ibl_r.zxy, perceptual_roughness * max_reflection_lod).rgb * 0.5;
-    vec3 ibl_spec = ibl_spec_color * (ibl_f * env_brdf.x + env_brdf.y);
-    color.rgb += (ibl_kd * ibl_diff  + ibl_spec);
+    color.rgb += ibl_kd * ibl_diff;
+
+    if (detail > 0.0) {
+        vec3 ibl_r = reflect(-v, n);
+        vec2 env_brdf = texture2DLod(brdf_lut, vec2(n_dot_v, perceptual_roughness), 0.0).rg;
+        vec3 ibl_spec_color = textureCubeLod(filtered_env_map, ibl_r.zxy, perceptual_roughness * max_reflection_lod).rgb * 0.5;
+        vec3 ibl_spec = ibl_spec_color * (ibl_f * env_brdf.x + env_brdf.y);
+        color.rgb += ibl_spec * detail;
+    }
 
     // Emission
     color.rgb += emission * 300;
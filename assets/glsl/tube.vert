@@ -14,6 +14,9 @@ attribute vec3 p3d_Normal;
 attribute vec4 p3d_Tangent;
 attribute vec2 p3d_MultiTexCoord0;
 
+// position of the tile within the ring, for instanced tiles
+attribute vec2 instance_offset;
+
 
 varying vec3 v_world_position;
 varying vec4 v_color;
@@ -27,42 +30,48 @@ uniform int num_segments;
 uniform vec2 radius;
 uniform vec2 start_center;
 uniform vec2 end_center;
-uniform float y;
+
+// sin(y / 25), sin(y / 177), cos(y / 13), computed on the CPU
+uniform vec4 y_phase;
 //uniform vec2 bending;
 
 const float TAU = 6.283185307179586;
 const vec4 fog_color = vec4(0.001, 0, 0, 1);
 
 void main() {
-    vec4 model_position = p3d_Vertex;
+    vec4 vertex = p3d_Vertex;
+    vertex.xy += instance_offset;
+
+    vec4 model_position = vertex;
     vec3 model_normal = p3d_Normal;
     vec3 model_tangent = p3d_Tangent.xyz;
 
-    float phi = p3d_Vertex.x * (TAU / (num_segments * 2));
+    float phi = vertex.x * (TAU / (num_segments * 2));
 
-    float rt = (p3d_Vertex.y / 40 + 0.5);
+    float rt = (vertex.y / 40 + 0.5);
     float interp_radius = (radius[1] * rt + radius[0] * (1-rt));
 
-    float world_y = p3d_Vertex.y + p3d_ModelMatrix[3].y;
+    float world_y = vertex.y + p3d_ModelMatrix[3].y;
     float effect_fac = smoothstep(20, 100, world_y) * level_params[1] / interp_radius;
-    phi += effect_fac * sin(y / 25);
+    phi += effect_fac * y_phase.x;
 
     //phi += (y + p3d_Vertex.y + p3d_ModelMatrix[3].y) * 0.02;
 
-    float rad = interp_radius - p3d_Vertex.z;
+    float rad = interp_radius - vertex.z;
 
     model_position.x = sin(phi) * rad;
-    model_position.y = p3d_Vertex.y + p3d_ModelMatrix[3].y;
+    model_position.y = vertex.y + p3d_ModelMatrix[3].y;
     model_position.z = -cos(phi) * rad;
     model_position.w = 1;
 
-    vec2 center = (end_center * rt + start_center * (1-rt));
+    // The x and z of the model matrix offset the instances of a branch
+    vec2 center = (end_center * rt + start_center * (1-rt)) + p3d_ModelMatrix[3].xz;
     model_position.xz += center;
 
     //vec2 bending = vec2(sin(y / 20), cos(y / 10)) * 0.0001 * effect_fac;
     //vec2 bending = vec2(sin(y / 200), model_position.y) * 0.00002;
     float clamped_world_y = max(0, world_y - 10);
-    vec2 bending = (vec2(sin(y / 177) + sin(model_position.y / 5), cos(y / 13) + cos(model_position.y / 5)) * level_params[2] + vec2(sin(model_position.y / 369), cos(model_position.y / 231)) * level_params[3]) * clamped_world_y * clamped_world_y;
+    vec2 bending = (vec2(y_phase.y + sin(model_position.y / 5), y_phase.z + cos(model_position.y / 5)) * level_params[2] + vec2(sin(model_position.y / 369), cos(model_position.y / 231)) * level_params[3]) * clamped_world_y * clamped_world_y;
 
     //model_normal += vec3(0, (radius[0] - radius[1]) / 40 + dot(normalize(model_position.xz), bending.xy) * 0.1, 0);
     model_normal = normalize(model_normal);
@@ -88,7 +97,7 @@ void main() {
     v_texcoord = (p3d_TextureMatrix * vec4(p3d_MultiTexCoord0, 0, 1)).xy;
 
     // occlude
-    v_color.a = min(1.0, (p3d_Vertex.z + 4) / 5.0);
+    v_color.a = min(1.0, (vertex.z + 4) / 5.0);
 
     // Exponential fog
     float fog_distance = length(view_position.xyz / view_position.w);
@@ -0,0 +1,36 @@
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import (
+    load_prc_file,
+    load_prc_file_data,
+    Filename,
+)
+from argparse import ArgumentParser
+from glob import glob
+import os
+
+
+parser = ArgumentParser(description="Processes the segments model once, so the game can load the result directly.")
+parser.add_argument('--segments', default='assets/bam/segments/segments.bam', help="segments model to bake")
+args = parser.parse_args()
+
+load_prc_file(Filename.expand_from("$MAIN_DIR/settings.prc"))
+load_prc_file_data("", "window-type none\naudio-library-name null\n")
+
+from src.tube import bake_segments, get_baked_segments_path
+
+
+base = ShowBase()
+
+baked_path = get_baked_segments_path(args.segments)
+if baked_path is None:
+    raise SystemExit(f"{args.segments} does not exist")
+
+# Remove bakes of earlier versions of the model
+for old_path in glob(args.segments.rsplit('.', 1)[0] + "-baked-*.bam"):
+    if os.path.abspath(old_path) != os.path.abspath(baked_path):
+        print(f"Removing {old_path}")
+        os.remove(old_path)
+
+print(f"Baking {args.segments} to {baked_path}...")
+bake_segments(base.loader.load_model(args.segments, noCache=True), baked_path)
+print("Done.")
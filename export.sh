@@ -1,2 +1,4 @@
 cd assets
 blend2bam blender bam --textures copy --blender-dir "C:/Program Files/Blender Foundation/Blender 4.0/"
+cd ..
+python bake_segments.py
@@ -0,0 +1,55 @@
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import (
+    load_prc_file,
+    load_prc_file_data,
+    Filename,
+    PandaSystem,
+)
+from argparse import ArgumentParser
+import platform
+import sys
+
+
+parser = ArgumentParser(description="Times the hot paths of the game and compares them against a baseline.")
+parser.add_argument('--seed', type=int, default=1, help="seed for the tube generator")
+parser.add_argument('--segments', default='assets/bam/segments/segments.bam', help="segments model to load")
+parser.add_argument('--filter', help="only run benchmarks whose name contains this")
+parser.add_argument('--output', help="write the results to this JSON file")
+parser.add_argument('--baseline', help="compare against the results in this JSON file")
+parser.add_argument('--threshold', type=float, help="slowdown ratio against the baseline that counts as a regression")
+args = parser.parse_args()
+
+load_prc_file(Filename.expand_from("$MAIN_DIR/settings.prc"))
+load_prc_file_data("", "window-type none\naudio-library-name null\n")
+
+import src.tube
+src.tube.THREADED_GENERATION = False
+
+from src.benchmarks import Context, run_benchmarks, compare_results, load_results, save_results, REGRESSION_THRESHOLD
+
+
+base = ShowBase()
+
+# There is no window, so there is no camera either
+base.camera = base.render.attach_new_node("camera")
+
+print("Loading segments...")
+ctx = Context(base.loader.load_model(args.segments), args.seed)
+results = run_benchmarks(ctx, args.filter)
+ctx.destroy()
+
+if args.output:
+    save_results(
+        args.output, results,
+        seed=args.seed,
+        python=platform.python_version(),
+        panda3d=PandaSystem.get_version_string(),
+        machine=platform.machine(),
+    )
+
+if args.baseline:
+    print()
+    regressions = compare_results(results, load_results(args.baseline), args.threshold or REGRESSION_THRESHOLD)
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
@@ -1,42 +1,53 @@
-from direct.showbase.ShowBase import ShowBase
-from direct.actor.Actor import Actor
-from panda3d.core import (
-    load_prc_file,
-    Filename,
-    AmbientLight,
-    SamplerState,
-)
-import simplepbr
-
-from src.game import Game
+from src import startup
 
+with startup.phase("import panda3d, simplepbr"):
+    from direct.showbase.ShowBase import ShowBase
+    from direct.actor.Actor import Actor
+    from panda3d.core import (
+        load_prc_file,
+        Filename,
+        AmbientLight,
+        SamplerState,
+    )
+    import simplepbr
 
 load_prc_file(Filename.expand_from("$MAIN_DIR/settings.prc"))
 
-base = ShowBase()
-base.set_background_color((0, 0, 0, 1))
+# src.tube compiles the tube shader when it is imported
+with startup.phase("import src.tube"):
+    import src.tube
+
+with startup.phase("import src.game"):
+    from src.game import Game
+
+with startup.phase("open window"):
+    base = ShowBase()
+    base.set_background_color((0, 0, 0, 1))
 
-env_pool = simplepbr.envpool.EnvPool.ptr()
-env_map = env_pool.load('assets/env/aircraft_workshop_01.env')
-env_map.cubemap.set_minfilter(SamplerState.FT_linear_mipmap_linear)
-env_map.cubemap.set_magfilter(SamplerState.FT_linear_mipmap_linear)
-env_map.filtered_env_map.set_minfilter(SamplerState.FT_linear_mipmap_linear)
-env_map.filtered_env_map.set_magfilter(SamplerState.FT_linear_mipmap_linear)
+with startup.phase("load env map"):
+    env_pool = simplepbr.envpool.EnvPool.ptr()
+    env_map = env_pool.load('assets/env/aircraft_workshop_01.env')
+    env_map.cubemap.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    env_map.cubemap.set_magfilter(SamplerState.FT_linear_mipmap_linear)
+    env_map.filtered_env_map.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    env_map.filtered_env_map.set_magfilter(SamplerState.FT_linear_mipmap_linear)
 
-simplepbr.init(
-    msaa_samples=4,
-    max_lights=0,
-    use_normal_maps=True,
-    use_emission_maps=True,
-    enable_shadows=False,
-    enable_hardware_skinning=False,
-    env_map=env_map,
-)
+with startup.phase("simplepbr.init"):
+    pipeline = simplepbr.init(
+        msaa_samples=4,
+        max_lights=0,
+        use_normal_maps=True,
+        use_emission_maps=True,
+        enable_shadows=False,
+        enable_hardware_skinning=False,
+        env_map=env_map,
+    )
 
-for task in base.taskMgr.getTasksNamed('simplepbr update'):
-    task.sort = 49
+    for task in base.taskMgr.getTasksNamed('simplepbr update'):
+        task.sort = 49
 
-base.taskMgr.step()
+with startup.phase("first frame"):
+    base.taskMgr.step()
 
 alight = AmbientLight('alight')
 alight.set_color((0, 0, 0, 1))
@@ -44,7 +55,7 @@ render.set_light(render.attach_new_node(alight))
 
 base.disable_mouse()
 
-game = Game()
+game = Game(pipeline)
 
 base.accept('f12', base.screenshot)
 
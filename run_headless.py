@@ -0,0 +1,51 @@
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import (
+    load_prc_file,
+    load_prc_file_data,
+    Filename,
+    ClockObject,
+)
+from argparse import ArgumentParser
+
+
+parser = ArgumentParser(description="Runs the game simulation without a window, for profiling.")
+parser.add_argument('--seed', type=int, default=1, help="seed for the tube generator")
+parser.add_argument('--steps', type=int, default=20000, help="number of simulation steps to run")
+parser.add_argument('--fps', type=float, default=60.0, help="simulated frame rate")
+parser.add_argument('--step-time', type=float, default=1 / 60, help="length of a simulation step, as the quality tiers set it")
+parser.add_argument('--input', help="file with scripted button presses, made up from the seed if omitted")
+parser.add_argument('--segments', default='assets/bam/segments/segments.bam', help="segments model to load")
+parser.add_argument('--threaded', action='store_true', help="generate rings on a thread (not reproducible)")
+args = parser.parse_args()
+
+load_prc_file(Filename.expand_from("$MAIN_DIR/settings.prc"))
+load_prc_file_data("", "window-type none\naudio-library-name null\n")
+
+import src.tube
+src.tube.THREADED_GENERATION = args.threaded
+
+from src.tube import find_baked_segments
+from src.headless import HeadlessRun, ScriptedInput, load_input_script, make_input_script
+
+
+base = ShowBase()
+
+# Advance the clock by exactly one frame every frame, however long it takes
+base.clock.set_mode(ClockObject.M_non_real_time)
+base.clock.set_frame_rate(args.fps)
+
+# There is no window, so there is no camera either
+base.camera = base.render.attach_new_node("camera")
+
+if args.input:
+    events = load_input_script(args.input)
+else:
+    events = make_input_script(args.seed, args.steps, args.step_time)
+
+print("Loading segments...")
+segments = base.loader.load_model(find_baked_segments(args.segments))
+
+run = HeadlessRun(segments, args.seed, ScriptedInput(events), args.step_time)
+run.run(args.steps)
+run.report()
+run.destroy()
@@ -0,0 +1,48 @@
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import (
+    load_prc_file,
+    load_prc_file_data,
+    Filename,
+)
+from argparse import ArgumentParser
+import time
+
+from src.seedfarm import analyze_seeds, summarize, save_results, MAX_RINGS
+
+
+def main():
+    parser = ArgumentParser(description="Checks that the tube can be passed for many seeds, and how hard it is.")
+    parser.add_argument('--seeds', type=int, default=1000, help="number of seeds to check")
+    parser.add_argument('--first-seed', type=int, default=0, help="first seed to check")
+    parser.add_argument('--rings', type=int, default=MAX_RINGS, help="maximum number of rings to check per seed")
+    parser.add_argument('--processes', type=int, help="number of worker processes, one per CPU if omitted")
+    parser.add_argument('--segments', default='assets/bam/segments/segments.bam', help="segments model to load")
+    parser.add_argument('--output', help="write the results for every seed to this JSON file")
+    args = parser.parse_args()
+
+    load_prc_file(Filename.expand_from("$MAIN_DIR/settings.prc"))
+    load_prc_file_data("", "window-type none\naudio-library-name null\n")
+
+    from src.tube import make_tilesets, find_baked_segments, LEVEL, Y_SPACING
+    from src.layout import TilePalette
+
+    base = ShowBase()
+
+    print("Loading segments...")
+    palette = TilePalette(make_tilesets(base.loader.load_model(find_baked_segments(args.segments))))
+
+    start_time = time.perf_counter()
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    results = list(analyze_seeds(palette, seeds, LEVEL, Y_SPACING, args.rings, args.processes))
+    elapsed = time.perf_counter() - start_time
+
+    print(f"Checked {len(results)} seeds in {elapsed:.1f} s, {len(results) / elapsed:.0f} seeds/s")
+    summarize(results)
+
+    if args.output:
+        save_results(args.output, results, level=LEVEL, max_rings=args.rings)
+
+
+# The worker processes import this module too, without running main()
+if __name__ == '__main__':
+    main()
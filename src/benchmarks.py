@@ -0,0 +1,252 @@
+from panda3d.core import NodePath, Vec4
+from statistics import median
+from random import Random
+import time
+import json
+
+from . import tube as tube_module
+from .tube import Tube, TileSet, NavType
+from .layout import RingLayout, LayoutGenerator
+from .ship import Ship, ShipControls, PathHistory
+from .donk import Collisions
+
+
+# A ratio of the median time against the baseline above this is a regression
+REGRESSION_THRESHOLD = 1.25
+
+benchmarks = []
+
+
+def benchmark(func):
+    "Registers a benchmark function, which returns a dict of measurements."
+
+    benchmarks.append(func)
+    return func
+
+
+def measure(func, number=1000, repeat=5, setup=None):
+    """Calls func number times, repeat times over, and returns the best and the
+    median time per call in microseconds.  If setup is given, it is called
+    before every call to func, and each call is timed on its own."""
+
+    times = []
+    for i in range(repeat):
+        if setup is None:
+            start_time = time.perf_counter()
+            for j in range(number):
+                func()
+            times.append((time.perf_counter() - start_time) / number)
+        else:
+            elapsed = 0.0
+            for j in range(number):
+                setup()
+                start_time = time.perf_counter()
+                func()
+                elapsed += time.perf_counter() - start_time
+            times.append(elapsed / number)
+
+    return {
+        'best_us': min(times) * 1e6,
+        'median_us': median(times) * 1e6,
+        'calls': number * repeat,
+    }
+
+
+class Context:
+    "The game objects shared between the benchmarks."
+
+    def __init__(self, segments, seed):
+        self.segments = segments
+        self.seed = seed
+
+        # Keep an untouched copy around, since TileSet.add modifies the model
+        self.pristine_segments = segments.copy_to(NodePath())
+
+        self.tube = Tube(segments, seed=seed)
+        self.ship = Ship()
+        self.controls = ShipControls(self.ship, self.tube, lambda button: False)
+        self.donk = Collisions(self.tube, self.controls)
+
+    def destroy(self):
+        self.donk.destroy()
+        self.controls.destroy()
+        self.ship.destroy()
+        self.tube.destroy()
+
+
+def bench_calc_types(ctx, count):
+    layout = LayoutGenerator(ctx.tube.palette, ctx.seed)
+    layout.last_ring = RingLayout([0] * count)
+    layout.last_ring.exits = [(i, 1, 1) for i in range(0, count, 3)]
+
+    return measure(lambda: layout.calc_types(count, allow_swervible=True))
+
+
+@benchmark
+def calc_types_6(ctx):
+    return bench_calc_types(ctx, 6)
+
+
+@benchmark
+def calc_types_60(ctx):
+    return bench_calc_types(ctx, 60)
+
+
+@benchmark
+def calc_types_200(ctx):
+    return bench_calc_types(ctx, 200)
+
+
+def bench_gen_ring(ctx, instanced):
+    tube = ctx.tube
+    random = Random(ctx.seed)
+    ts = tube.palette.tilesets[tube_module.LEVEL]
+    tiles = ts.tile1_by_type[NavType.PASSABLE] or ts.tile1_by_type[NavType.EMPTY]
+
+    def gen_ring():
+        layout = RingLayout(random.choices(tiles, k=tube.last_ring.num_segments))
+        tube.ring_pool.release(tube.build_ring(layout))
+
+    prev_instanced = tube_module.INSTANCED_TILES
+    tube_module.INSTANCED_TILES = instanced
+    prev_last_ring = tube.last_ring
+    try:
+        # Without instancing, every ring is flattened anew
+        return measure(gen_ring, number=50)
+    finally:
+        tube_module.INSTANCED_TILES = prev_instanced
+        tube.last_ring = prev_last_ring
+
+
+@benchmark
+def gen_ring_instanced(ctx):
+    return bench_gen_ring(ctx, True)
+
+
+@benchmark
+def gen_ring_flatten_strong(ctx):
+    return bench_gen_ring(ctx, False)
+
+
+@benchmark
+def layout_rings(ctx):
+    "Lays out the first hundred rings of the tube, without building them."
+
+    def gen_layouts():
+        generator = LayoutGenerator(ctx.tube.palette, ctx.seed).gen_tube(tube_module.LEVEL)
+        for i in range(100):
+            next(generator)
+
+    return measure(gen_layouts, number=10)
+
+
+@benchmark
+def collisions_update(ctx):
+    return measure(lambda: ctx.donk.update(0.02))
+
+
+def make_long_history(num_samples):
+    history = PathHistory(num_samples * 0.01)
+    for i in range(num_samples):
+        history.append(i * 0.01, Vec4(i, 1, 0, 0))
+    return history
+
+
+@benchmark
+def path_history_append(ctx):
+    history = make_long_history(10000)
+    t = [100.0]
+
+    def append():
+        t[0] += 0.01
+        history.append(t[0], Vec4(t[0], 1, 0, 0))
+
+    return measure(append)
+
+
+@benchmark
+def path_history_sample(ctx):
+    history = make_long_history(10000)
+    return measure(lambda: history.sample(50.005))
+
+
+@benchmark
+def path_history_rewind(ctx):
+    history = make_long_history(10000)
+    t = [100.0]
+
+    def rewind():
+        t[0] -= 0.001
+        history.rewind(t[0])
+
+    return measure(rewind)
+
+
+@benchmark
+def multitrack_do_fade(ctx):
+    music = ctx.tube.music
+    music.set_playing_tracks(('peace', 'medium'))
+
+    # The tracks are loaded in the background
+    while music.loading:
+        base.task_mgr.step()
+
+    return measure(music.do_fade)
+
+
+@benchmark
+def tileset_add(ctx):
+    models = []
+
+    def copy_model():
+        models.append(ctx.pristine_segments.copy_to(NodePath()))
+
+    def add_all():
+        model = models.pop()
+        tilesets = {name: TileSet(name) for name in tube_module.LEVELS}
+        for n in model.children:
+            prefix = n.name.split('_', 1)[0]
+            if prefix in tilesets:
+                tilesets[prefix].add(n)
+
+    return measure(add_all, number=1, repeat=3, setup=copy_model)
+
+
+def run_benchmarks(ctx, pattern=None):
+    results = {}
+    for func in benchmarks:
+        if pattern and pattern not in func.__name__:
+            continue
+        results[func.__name__] = func(ctx)
+        print(f"{func.__name__:28s} {results[func.__name__]['median_us']:12.2f} us")
+    return results
+
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    "Prints how the results compare to the baseline, returns the regressions."
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:28s} {'':12s} (not in baseline)")
+            continue
+
+        ratio = result['median_us'] / baseline[name]['median_us']
+        if ratio > threshold:
+            regressions.append(name)
+            note = "REGRESSION"
+        else:
+            note = ""
+        print(f"{name:28s} {baseline[name]['median_us']:12.2f} us -> {result['median_us']:12.2f} us {ratio:6.2f}x {note}")
+
+    return regressions
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def save_results(path, results, **meta):
+    with open(path, 'w') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=2, sort_keys=True)
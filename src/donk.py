@@ -2,10 +2,27 @@ from direct.showbase.DirectObject import DirectObject
 from panda3d.core import *
 from math import floor, ceil
 from random import random, choice
+import numpy
+
+from .tube import COLLISION_MATERIALS
 
 
 DONK_DEBUG = False
 SCRAPE_FADEOUT_SPEED = 2.0
+SHIP_RADIUS = 0.1
+
+# Test the ship against the baked collision profiles of each tile rather than
+# traversing the collision scene graph (which is still used for DONK_DEBUG)
+COLLISION_PROFILES = True
+
+# Sweep the ship along its motion since the last step when steps are longer
+# than this, so that it can't pass through thin walls (only with
+# COLLISION_PROFILES).  At shorter steps, sweeping doesn't change what the ship
+# hits, so it isn't worth doing.
+SWEEP_STEP_TIME = 1 / 60
+
+# Don't sweep across jumps further than this, ie. when rewinding
+MAX_SWEEP_DISTANCE = 5.0
 
 
 class Collisions(DirectObject):
@@ -19,7 +36,7 @@ class Collisions(DirectObject):
         #self.croot.reparent_to(render)
 
         self.cship = self.croot.attach_new_node(CollisionNode("ship"))
-        self.cship.node().add_solid(CollisionSphere((0, 0, 0), 0.1))
+        self.cship.node().add_solid(CollisionSphere((0, 0, 0), SHIP_RADIUS))
 
         self.pusher = CollisionHandlerPusher()
         self.pusher.add_collider(self.cship, self.cship)
@@ -34,6 +51,21 @@ class Collisions(DirectObject):
         self.scraping = 0.0
         self.scrape = None
 
+        # Segment nodes that are currently unstashed in the collision scene
+        self.active_segments = []
+
+        # (ring, segment index) pairs the ship touched during the last step
+        self.contacts = set()
+
+        # Where the ship was during the last step, for sweeping
+        self.last_ship_r = None
+        self.last_ship_z = None
+        self.last_tube_y = None
+        self.accept('tube-rebase', self.on_tube_rebase)
+
+        self.solids_tested = 0
+        self.total_solids_tested = 0
+
         self.steel_bumps = [
             base.loader.load_sfx('assets/sfx/bump1.wav'),
             base.loader.load_sfx('assets/sfx/bump2.wav'),
@@ -68,8 +100,13 @@ class Collisions(DirectObject):
             cam.look_at(0, 0, -1)
 
     def destroy(self):
+        self.ignore_all()
         self.croot.remove_node()
 
+    def on_tube_rebase(self, shift):
+        if self.last_tube_y is not None:
+            self.last_tube_y -= shift
+
     def make_debug_camera(self, frame, lens):
         frame = Vec4(frame)
 
@@ -87,26 +124,49 @@ class Collisions(DirectObject):
         if self.tube.paused:
             return
 
-        self.croot.node().remove_all_children()
-        self.cship.reparent_to(self.croot)
-
         ship_z = self.controls.get_ship_z_above_ground()
         self.cship.set_pos(0, 0, ship_z)
 
         ship_r = self.controls.ship.root.get_r() / -360.0
 
+        # How far the ship moved since the last step, with x still in turns
+        motion = None
+        if dt > SWEEP_STEP_TIME and self.last_tube_y is not None:
+            move_y = self.tube.y - self.last_tube_y
+            if 0 <= move_y < MAX_SWEEP_DISTANCE:
+                move_r = (ship_r - self.last_ship_r + 0.5) % 1.0 - 0.5
+                motion = (move_r, move_y, ship_z - self.last_ship_z)
+
+        self.last_ship_r = ship_r
+        self.last_ship_z = ship_z
+        self.last_tube_y = self.tube.y
+
+        # The collision profiles of each ring were set up when it was
+        # generated, so all we do here is pick out the segments under the ship
+        prev_segments = self.active_segments
+        self.active_segments = []
+        self.solids_tested = 0
+
+        use_profiles = COLLISION_PROFILES and not DONK_DEBUG
+        push = Vec3(0)
+        contacts = set()
+        profiles = []
+        offsets = []
+        motions = []
+        segments = []
+
         current_ring = self.tube.current_ring
         for ring in (current_ring, self.tube.next_ring):
-            seg_count = len(ring.collision_nodes)
+            if not use_profiles and not ring.collision_root.has_parent():
+                # Only the traverser needs the collision nodes themselves
+                ring.add_collision_segments()
+                ring.collision_root.reparent_to(self.croot)
+
+            seg_count = len(ring.collision_profiles)
 
             i0 = int(floor(ship_r * seg_count)) % seg_count
             i1 = int(ceil(ship_r * seg_count)) % seg_count
 
-            cnodes0 = ring.collision_nodes[i0]
-            cnodes1 = ring.collision_nodes[i1] if i0 != i1 else ()
-
-            ship_x = ship_r * ring.r_to_x
-
             x0 = (((i0 / seg_count) - ship_r) % 1.0) * ring.r_to_x
             x1 = (((i1 / seg_count) - ship_r) % 1.0) * ring.r_to_x
 
@@ -115,21 +175,51 @@ class Collisions(DirectObject):
             if x1 > ring.r_to_x // 2:
                 x1 -= ring.r_to_x
 
-            if cnodes0 is not None:
-                for cnode_path in cnodes0:
-                    cnode_path = cnode_path.copy_to(self.croot)
-                    cnode_path.set_pos(x0, ring.node_path.get_y(), 0)
-                    if DONK_DEBUG:
-                        cnode_path.show()
-
-            if cnodes1 is not None:
-                for cnode_path in cnodes1:
-                    cnode_path = cnode_path.copy_to(self.croot)
-                    cnode_path.set_pos(x1, ring.node_path.get_y(), 0)
-                    if DONK_DEBUG:
-                        cnode_path.show()
-
-        self.trav.traverse(self.croot)
+            for i, x in ((i0, x0),) if i1 == i0 else ((i0, x0), (i1, x1)):
+                if not use_profiles:
+                    self.activate_segment(ring.collision_segments[i], x, ring.y)
+                    continue
+
+                profile = ring.collision_profiles[i]
+                if profile is None:
+                    continue
+
+                pos = (-x, -ring.y, ship_z)
+                if motion is not None:
+                    move = (motion[0] * ring.r_to_x, motion[1], motion[2])
+                else:
+                    move = (0.0, 0.0, 0.0)
+
+                # Cheap rejection against the bounds of the whole tile first,
+                # covering the whole path of the ship since the last step
+                bounds, rows = profile
+                r = SHIP_RADIUS
+                for p, m, lo, hi in zip(pos, move, bounds[:3], bounds[3:]):
+                    if min(p, p - m) > hi + r or max(p, p - m) < lo - r:
+                        break
+                else:
+                    profiles.append(rows)
+                    offsets.append(pos)
+                    motions.append(move)
+                    segments.append((ring, i))
+
+        if profiles:
+            for segment, material in self.test_profiles(profiles, offsets, motions, segments, push):
+                contacts.add(segment)
+                if segment not in self.contacts:
+                    messenger.send('into-' + material, [None])
+
+        self.contacts = contacts
+
+        for seg_np in prev_segments:
+            if seg_np not in self.active_segments:
+                seg_np.stash()
+
+        self.total_solids_tested += self.solids_tested
+        if use_profiles:
+            self.cship.set_pos(self.cship.get_pos() + push)
+        else:
+            self.trav.traverse(self.croot)
 
         moved = self.cship.get_pos()
         if moved.x != 0 or moved.y != 0:
@@ -160,6 +250,67 @@ class Collisions(DirectObject):
 
         self.cship.set_pos(0, 0, ship_z)
 
+    def activate_segment(self, segment, x, y):
+        if segment is None:
+            return
+
+        seg_np, num_solids = segment
+        if seg_np.is_stashed():
+            seg_np.unstash()
+            if DONK_DEBUG:
+                for cnode_path in seg_np.children:
+                    cnode_path.show()
+
+        seg_np.set_pos(x, y, 0)
+        self.active_segments.append(seg_np)
+        self.solids_tested += num_solids
+
+    def test_profiles(self, profiles, offsets, motions, segments, push):
+        """Tests the ship, at the given positions relative to each segment,
+        against their baked collision profiles in one go.  Walls the ship
+        crossed entirely while making the given motion are hit too.  Adds the
+        push out of the walls to push, and returns the segments that were hit
+        along with the material of the deepest wall hit in each."""
+
+        counts = [len(profile) for profile in profiles]
+        rows = numpy.concatenate(profiles)
+        pos = numpy.repeat(numpy.array(offsets, dtype=numpy.float32), counts, axis=0)
+        move = numpy.repeat(numpy.array(motions, dtype=numpy.float32), counts, axis=0)
+        self.solids_tested += len(rows)
+
+        r = SHIP_RADIUS
+        lo = rows[:, 4:7] - r
+        hi = rows[:, 7:10] + r
+        normals = rows[:, 0:3]
+        dist = (normals * pos).sum(axis=1) + rows[:, 3]
+        hits = (numpy.abs(dist) < r) & ((pos > lo) & (pos < hi)).all(axis=1)
+
+        # Walls that were in front of the ship at the last step and are now
+        # behind it; check whether the point where the ship first touched the
+        # wall's plane lies within the wall's bounds
+        last_dist = dist - (normals * move).sum(axis=1)
+        crossed = (last_dist >= r) & (dist <= -r)
+        if crossed.any():
+            t = (last_dist - r) / numpy.where(crossed, last_dist - dist, 1.0)
+            contact = pos - move * (1.0 - t[:, None]) - normals * r
+            hits |= crossed & ((contact > lo) & (contact < hi)).all(axis=1)
+
+        if not hits.any():
+            return ()
+
+        depth = numpy.where(hits, r - dist, 0.0)
+        push += Vec3(*(normals * depth[:, None]).sum(axis=0))
+
+        result = []
+        start = 0
+        for segment, count in zip(segments, counts):
+            seg_depth = depth[start:start + count]
+            if seg_depth.any():
+                deepest = start + seg_depth.argmax()
+                result.append((segment, COLLISION_MATERIALS[int(rows[deepest, 10])]))
+            start += count
+        return result
+
     def start_scrape(self, material):
         if self.scraping or self.tube.paused:
             return False
@@ -4,18 +4,34 @@ from panda3d.core import (
 from direct.interval.IntervalGlobal import Func, Sequence, Wait
 from direct.gui.OnscreenText import OnscreenText
 
-from .tube import Tube
+from .tube import Tube, find_baked_segments
 from .ship import Ship, ShipControls
 from .donk import Collisions
 from .title import Title
 from .space import Starfield
 from .cutscene import Cutscene
+from .profiler import ProfilerOverlay, section, steps
+from .timestep import FixedTimestep
+from .quality import QualityGovernor
+from . import startup
 
-from math import ceil
+
+# Length of a simulation step, and the most steps to run in a frame to catch up
+# after a slow frame.  Game takes the step length from the quality tier, which
+# makes it longer on slow machines; this one is for the headless runs.
+STEP_TIME = 1 / 60
+MAX_STEPS_PER_FRAME = 10
+
+# Loaded through its bake, made by bake_segments.py, if it's up to date
+SEGMENTS_PATH = 'assets/bam/segments/segments.bam'
+
+tube_section = section("Tube.update")
+controls_section = section("ShipControls.update")
+donk_section = section("Collisions.update")
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, pipeline=None):
         self.paused = False
         self.music = base.loader.load_music('assets/music/a/A-intro.ogg')
         self.music.set_loop(True)
@@ -24,24 +40,46 @@ class Game:
 
         base.camLens.set_fov(80)
 
-        self.cutscene = Cutscene("assets/bam/cutscenes/cutscene.bam")
+        with startup.phase("load cutscene"):
+            self.cutscene = Cutscene("assets/bam/cutscenes/cutscene.bam")
 
         self.segments = None
 
         self.text = OnscreenText(text='Loading...', pos=(0, -0.7), fg=(1, 1, 1, 1))
         self.task = None
-        base.graphicsEngine.renderFrame()
-        base.graphicsEngine.renderFrame()
-        self.title = Title()
-        self.starfield = Starfield()
-        base.graphicsEngine.renderFrame()
-        base.graphicsEngine.renderFrame()
-        loader.load_model('assets/bam/segments/segments.bam', callback=self.on_model_load)
+        self.tube = None
+        self.timestep = None
+        self.quality = QualityGovernor(pipeline)
+        self.profiler = ProfilerOverlay(self.quality)
+        with startup.phase("render loading screen"):
+            base.graphicsEngine.renderFrame()
+            base.graphicsEngine.renderFrame()
+        with startup.phase("load title"):
+            self.title = Title()
+        with startup.phase("create starfield"):
+            self.starfield = Starfield()
+            self.starfield.set_density(self.quality.tier.star_density)
+        base.accept('quality-changed', self.on_quality_changed)
+        with startup.phase("render title"):
+            base.graphicsEngine.renderFrame()
+            base.graphicsEngine.renderFrame()
+        startup.milestone("title visible")
+        loader.load_model(find_baked_segments(SEGMENTS_PATH), callback=self.on_model_load)
+
+    def on_quality_changed(self, tier):
+        self.starfield.set_density(tier.star_density)
+        if self.tube:
+            self.tube.set_num_rings(tier.num_rings)
+            self.tube.set_shading(tier.normal_maps, tier.emission_maps)
+        if self.timestep:
+            self.timestep.set_step_time(tier.step_time)
 
     def on_model_load(self, model):
         self.text.text = 'Press space to start'
         self.segments = model
         print("Model loaded.")
+        startup.milestone("segments loaded, playable")
+        startup.report()
 
     def launch(self):
         base.ignore('space')
@@ -59,15 +97,23 @@ class Game:
 
         if not self.segments:
             # force loading now
-            self.segments = loader.load_model('assets/bam/segments/segments.bam')
+            self.segments = loader.load_model(find_baked_segments(SEGMENTS_PATH))
 
-        self.tube = Tube(self.segments)
+        with startup.phase("build tube"):
+            self.tube = Tube(self.segments, num_rings=self.quality.tier.num_rings)
+            self.tube.set_shading(self.quality.tier.normal_maps, self.quality.tier.emission_maps)
+        startup.report("Launch timing")
         self.tube.root.reparent_to(render)
 
         self.controls = ShipControls(self.ship, self.tube)
 
         self.donk = Collisions(self.tube, self.controls)
 
+        self.timestep = FixedTimestep(self.quality.tier.step_time, MAX_STEPS_PER_FRAME)
+        self.interpolated = False
+        self.step_state = None # ship state after the last step
+        self.prev_step_state = None # ship state and distance, before it
+
         base.cam.set_p(0)
         base.cam.reparent_to(base.camera)
 
@@ -84,6 +130,7 @@ class Game:
         self.ship.destroy()
         self.controls.destroy()
         self.tube.destroy()
+        self.tube = None
         self.donk.destroy()
 
         #self.cutscene.actor.set_p(-90)
@@ -123,15 +170,43 @@ class Game:
             if new_volume == 0.0:
                 self.music.stop()
 
-        # Run simulation at least every 20 ms
         #if base.mouseWatcherNode.is_button_down('lshift'):
         #    dt *= 8
-        num_steps = ceil(dt / 0.020)
-        dt /= num_steps
-        num_steps = min(10, num_steps)
+        num_steps = self.timestep.advance(dt)
+        step_time = self.timestep.step_time
+        if num_steps and self.interpolated:
+            # Put the ship back where the simulation left it
+            self.controls.set_state(self.step_state)
+
         for i in range(num_steps):
-            self.tube.update(dt)
-            self.controls.update(dt)
-            self.donk.update(dt)
+            # By distance rather than y, which changes when the tube rebases
+            self.prev_step_state = (self.controls.get_state(), self.tube.y - self.tube.start_y)
+
+            with tube_section:
+                self.tube.update(step_time)
+            with controls_section:
+                self.controls.update(step_time)
+            with donk_section:
+                self.donk.update(step_time)
+            self.controls.end_step()
+        steps.add(num_steps)
+
+        self.interpolated = False
+        if self.tube.paused:
+            # Rewinding moves the ship and tube by itself
+            self.prev_step_state = None
+        elif self.prev_step_state is not None:
+            if num_steps:
+                self.step_state = self.controls.get_state()
+            self.show_between_steps(self.timestep.alpha)
 
         return task.cont
+
+    def show_between_steps(self, t):
+        "Shows the ship and tube in between the last two steps, for smoothness."
+
+        prev_state, prev_distance = self.prev_step_state
+        distance = self.tube.y - self.tube.start_y
+        self.tube.set_render_y(self.tube.start_y + prev_distance + (distance - prev_distance) * t)
+        self.controls.set_state(prev_state + (self.step_state - prev_state) * t)
+        self.interpolated = True
@@ -1,5 +1,7 @@
 from panda3d.core import AudioSound
 
+from .profiler import timed
+
 
 MAX_VOLUME = 0.5
 FADEIN_TIME = 2.0
@@ -7,28 +9,72 @@ FADEOUT_TIME = 2.0
 
 
 class MultiTrack:
+    """Plays a set of stems in sync, fading them in and out.  The stems are
+    loaded in the background when they're requested, and the silent ones are
+    stopped, to be resumed at the right position when they're needed again."""
+
     def __init__(self):
         self.mgr = base.musicManager
 
+        # Every registered track, by name, and the loaded ones
+        self.files = {}
         self.sounds = {}
+        self.loading = set()
+
+        # The tracks that should be audible, and the loaded ones that are
+        # actually running
         self.playing = set()
+        self.active = set()
+
+        # Where we are in the music, for starting stems in sync with the rest
+        self.time = 0.0
+        self.length = None
 
         self.task = None
 
     def load_track(self, name, file):
-        if name not in self.sounds:
-            self.sounds[name] = loader.load_music(file)
-            self.sounds[name].set_loop(False)
-            self.sounds[name].set_volume(0.0)
-            self.mgr.set_concurrent_sound_limit(len(self.sounds) + 1)
+        "Registers a track; it's loaded when request_tracks first asks for it."
+
+        self.files[name] = file
+
+    def request_tracks(self, tracks):
+        "Starts loading the given tracks in the background if they aren't yet."
+
+        for name in tracks:
+            if name not in self.sounds and name not in self.loading:
+                self.loading.add(name)
+                loader.load_music(self.files[name], callback=self.on_track_loaded, extraArgs=[name])
+
+    def on_track_loaded(self, sound, name):
+        if name not in self.loading:
+            # It was released or stopped while it was being loaded
+            return
+
+        self.loading.discard(name)
+        sound.set_loop(False)
+        sound.set_volume(0.0)
+        self.sounds[name] = sound
+        self.mgr.set_concurrent_sound_limit(len(self.sounds) + 1)
+
+        length = sound.length()
+        if length > 0.0 and (self.length is None or length < self.length):
+            self.length = length
+
+    def release_tracks(self, keep):
+        "Unloads the silent tracks that aren't in keep."
+
+        for name in tuple(self.sounds):
+            if name not in keep and name not in self.playing and self.sounds[name].get_volume() == 0.0:
+                self.sounds.pop(name).stop()
+                self.active.discard(name)
+
+        self.loading.intersection_update(keep)
 
     def set_playing_tracks(self, tracks):
         self.playing = set(tracks)
+        self.request_tracks(tracks)
 
     def play(self):
-        for sound in self.sounds.values():
-            sound.play()
-
         if not self.task:
             self.task = taskMgr.add(self.do_fade_task)
 
@@ -40,25 +86,52 @@ class MultiTrack:
         for sound in self.sounds.values():
             sound.stop()
 
+        self.active.clear()
+        self.loading.clear()
+
     def do_fade(self):
+        dt = base.clock.dt
+
+        # Follow the running stems if there are any, otherwise keep time
+        for name in self.active:
+            sound = self.sounds[name]
+            if sound.status() == AudioSound.PLAYING:
+                self.time = sound.get_time()
+                break
+        else:
+            self.time += dt
+            if self.length and self.time >= self.length:
+                self.time %= self.length
+
         restart = False
         for name, sound in self.sounds.items():
             vol = sound.get_volume()
             if name in self.playing:
+                if name not in self.active:
+                    sound.set_time(self.time)
+                    sound.play()
+                    self.active.add(name)
                 if vol < MAX_VOLUME:
-                    sound.set_volume(min(MAX_VOLUME, vol + base.clock.dt / FADEIN_TIME))
+                    sound.set_volume(min(MAX_VOLUME, vol + dt / FADEIN_TIME))
             else:
                 if vol > 0.0:
-                    sound.set_volume(max(0.0, vol - base.clock.dt / FADEOUT_TIME))
-
-            if sound.status() != AudioSound.PLAYING and sound.get_time() > 10.0:
+                    sound.set_volume(max(0.0, vol - dt / FADEOUT_TIME))
+                elif name in self.active:
+                    # Faded out completely; no sense in decoding it any more
+                    sound.stop()
+                    self.active.discard(name)
+                    continue
+
+            if name in self.active and sound.status() != AudioSound.PLAYING and sound.get_time() > 10.0:
                 restart = True
 
         if restart:
-            for sound in self.sounds.values():
-                sound.set_time(0.0)
-                sound.play()
+            self.time = 0.0
+            for name in self.active:
+                self.sounds[name].set_time(0.0)
+                self.sounds[name].play()
 
+    @timed("MultiTrack.do_fade")
     def do_fade_task(self, task):
         self.do_fade()
         return task.cont
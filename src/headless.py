@@ -0,0 +1,151 @@
+from collections import defaultdict
+from random import Random
+import time
+
+from .tube import Tube
+from .ship import Ship, ShipControls
+from .donk import Collisions
+from .game import STEP_TIME, MAX_STEPS_PER_FRAME
+from .timestep import FixedTimestep
+
+
+SUBSYSTEMS = 'tube', 'controls', 'donk'
+
+
+def load_input_script(path):
+    """Reads a list of (step, button, down) events from a file with lines like
+    "120 arrow_left down".  Blank lines and # comments are ignored."""
+
+    events = []
+    with open(path) as file:
+        for line in file:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            step, button, state = line.split()
+            events.append((int(step), button, state == 'down'))
+    return events
+
+
+def make_input_script(seed, num_steps, step_time=STEP_TIME):
+    "Makes up a reproducible sequence of steering left, right and not at all."
+
+    random = Random(seed)
+    events = []
+    step = 0
+    button = None
+    while step < num_steps:
+        if button is not None:
+            events.append((step, button, False))
+        button = random.choice((None, 'arrow_left', 'arrow_right'))
+        if button is not None:
+            events.append((step, button, True))
+        step += max(1, int(random.uniform(0.1, 1.5) / step_time))
+    return events
+
+
+class ScriptedInput:
+    "Stands in for the MouseWatcher, pressing buttons at the scripted steps."
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.next_event = 0
+        self.buttons_down = set()
+
+    def advance(self, step):
+        while self.next_event < len(self.events) and self.events[self.next_event][0] <= step:
+            _, button, down = self.events[self.next_event]
+            if down:
+                self.buttons_down.add(button)
+            else:
+                self.buttons_down.discard(button)
+            self.next_event += 1
+
+    def is_button_down(self, button):
+        return button in self.buttons_down
+
+
+class HeadlessRun:
+    """Runs the simulation the way Game does, but without a window or a player,
+    keeping track of how long each subsystem takes."""
+
+    def __init__(self, segments, seed, input, step_time=STEP_TIME):
+        self.input = input
+        self.step_time = step_time
+
+        self.ship = Ship()
+        self.ship.root.reparent_to(base.render)
+
+        self.tube = Tube(segments, seed=seed)
+        self.tube.root.reparent_to(base.render)
+
+        self.controls = ShipControls(self.ship, self.tube, input.is_button_down)
+        self.donk = Collisions(self.tube, self.controls)
+        self.timestep = FixedTimestep(step_time, MAX_STEPS_PER_FRAME)
+
+        self.num_steps = 0
+        self.num_crashes = 0
+        self.ended = False
+        self.times = defaultdict(float)
+
+        base.accept('endgame', self.on_endgame)
+        self.task = base.taskMgr.add(self.update, sort=1)
+
+    def destroy(self):
+        base.ignore('endgame')
+        self.task.remove()
+        self.ship.destroy()
+        self.controls.destroy()
+        self.tube.destroy()
+        self.donk.destroy()
+
+    def on_endgame(self):
+        self.ended = True
+
+    def update(self, task):
+        for i in range(self.timestep.advance(base.clock.dt)):
+            self.input.advance(self.num_steps)
+            was_paused = self.tube.paused
+
+            t0 = time.perf_counter()
+            self.tube.update(self.step_time)
+            t1 = time.perf_counter()
+            self.controls.update(self.step_time)
+            t2 = time.perf_counter()
+            self.donk.update(self.step_time)
+            self.controls.end_step()
+            t3 = time.perf_counter()
+
+            self.times['tube'] += t1 - t0
+            self.times['controls'] += t2 - t1
+            self.times['donk'] += t3 - t2
+            self.num_steps += 1
+
+            if self.tube.paused and not was_paused:
+                self.num_crashes += 1
+
+        return task.cont
+
+    def run(self, num_steps):
+        "Steps the task manager until the given number of steps have been run."
+
+        start_time = time.perf_counter()
+        while self.num_steps < num_steps and not self.ended:
+            base.taskMgr.step()
+        self.times['total'] += time.perf_counter() - start_time
+
+    def report(self):
+        total = self.times['total']
+        print(f"{self.num_steps} steps in {total:.3f} s, {self.num_steps / max(total, 1e-9):.1f} steps/s")
+        # By distance rather than y, which changes when the tube rebases
+        distance = self.tube.y - self.tube.start_y
+        print(f"reached distance {distance:.1f} with {self.num_crashes} crashes")
+
+        other = total
+        for name in SUBSYSTEMS:
+            spent = self.times[name]
+            other -= spent
+            print(f"  {name:10s} {spent * 1000:10.1f} ms {spent * 1e6 / max(self.num_steps, 1):8.1f} us/step")
+        print(f"  {'other':10s} {other * 1000:10.1f} ms")
+        print(self.tube.ring_cache)
+        print(self.tube.ring_pool)
@@ -0,0 +1,622 @@
+"""Decides what the tube looks like, without touching the scene graph.  The
+LayoutGenerator yields a RingLayout for each ring, referring to the tiles by
+their id in a TilePalette, which Tube.build_ring turns into geometry."""
+
+from array import array
+from random import Random
+from math import ceil
+from enum import Enum
+
+import numpy
+
+
+SECTION_LENGTH = 2
+TRENCH_DEPTH = 2.8
+
+
+class NavType(Enum):
+    EMPTY = 0
+    PASSABLE = 1
+    SWERVIBLE = 2 # sic
+    IMPASSABLE = 3
+    TUNNEL = 4 # non-swervable but passable
+
+    @property
+    def is_passable(self):
+        return self in (NavType.EMPTY, NavType.PASSABLE, NavType.TUNNEL)
+
+    @property
+    def is_swervible(self): #sic
+        return self in (NavType.SWERVIBLE, NavType.PASSABLE, NavType.EMPTY)
+
+
+# calc_types works with the plain values, which are faster to look at
+EMPTY, PASSABLE, SWERVIBLE, IMPASSABLE, TUNNEL = (nt.value for nt in NavType)
+
+# Indexed by NavType value
+IS_PASSABLE = tuple(nt.is_passable for nt in NavType)
+IS_OPEN = tuple(nt in (NavType.PASSABLE, NavType.EMPTY) for nt in NavType)
+
+
+class TileIds:
+    "The tiles of a TileSet, by id instead of as (node, collision nodes)."
+
+    def __init__(self, ts, ids):
+        def to_ids(segs):
+            return [ids[n.name] for n, cnps in segs]
+
+        self.name = ts.name
+        self.segments = {name: ids[n.name] for name, (n, cnps) in ts.segments.items()}
+        self.entrance_trenches = to_ids(ts.entrance_trenches)
+        self.exit_trenches = to_ids(ts.exit_trenches)
+        self.middle_trenches = to_ids(ts.middle_trenches)
+        self.impassable_trenches = to_ids(ts.impassable_trenches)
+        self.tile1_by_type = {type: to_ids(segs) for type, segs in ts.tile1_by_type.items()}
+        self.tile3_by_type = {type: to_ids(segs) for type, segs in ts.tile3_by_type.items()}
+
+
+class TilePalette:
+    "Numbers the tiles of all the tilesets, so that layouts can refer to them."
+
+    def __init__(self, tilesets):
+        self.tiles = [] # id: (node, collision nodes)
+        self.ids = {}
+
+        for ts in tilesets.values():
+            for seg in ts.tiles:
+                self.ids[seg[0].name] = len(self.tiles)
+                self.tiles.append(seg)
+
+        self.tilesets = {name: TileIds(ts, self.ids) for name, ts in tilesets.items()}
+
+        # id: NavType value, for rings that don't say what their tiles are for
+        self.nav_types = array('B', (NavType.PASSABLE.value,)) * len(self.tiles)
+        for name, id in self.ids.items():
+            if 'impassable' in name:
+                self.nav_types[id] = NavType.IMPASSABLE.value
+
+        for ts in self.tilesets.values():
+            for by_type in ts.tile1_by_type, ts.tile3_by_type:
+                for type, ids in by_type.items():
+                    for id in ids:
+                        self.nav_types[id] = type.value
+            for id in ts.entrance_trenches + ts.middle_trenches + ts.exit_trenches:
+                self.nav_types[id] = NavType.TUNNEL.value
+            for id in ts.impassable_trenches:
+                self.nav_types[id] = NavType.IMPASSABLE.value
+
+    def __getstate__(self):
+        "Leaves out the nodes, so that other processes can lay out tubes."
+
+        state = self.__dict__.copy()
+        state['tiles'] = None
+        return state
+
+
+class RingLayout:
+    "Everything that Tube.build_ring needs to know to construct a ring."
+
+    __slots__ = (
+        'tiles', 'width', 'start_count', 'count', 'level', 'level_params',
+        'play_tracks', 'override_gravity', 'start_depth', 'end_depth',
+        'shader_end_radius', 'types', 'exits', 'event', 'extension',
+        'extension_skip', 'branch',
+    )
+
+    def __init__(self, tiles, width=1, start_count=None, level='steel', level_params=(0.0, 0.0, 0.0, 0.0), play_tracks=(), override_gravity=None):
+        self.tiles = array('H', tiles)
+        self.width = width
+        self.count = len(self.tiles) * width
+        self.start_count = self.count if start_count is None else start_count
+        self.level = level
+        self.level_params = level_params # fog, twist, bend time, bend y
+        self.play_tracks = play_tracks
+        self.override_gravity = override_gravity
+        self.start_depth = 0.0
+        self.end_depth = 0.0
+        self.shader_end_radius = None
+        self.types = None # array of NavType values, if calc_types decided them
+        self.exits = [] # i, sw_left, sw_right
+        self.event = None
+
+        # Rows of tiles shown past the end of the ring, and whether the ring
+        # branches off into a separate tube for each third tile of the last
+        self.extension = None
+        self.extension_skip = 0
+        self.branch = False
+
+
+class LayoutGenerator:
+    def __init__(self, palette, seed=None, extension_length=30):
+        self.palette = palette
+        self.random = Random(seed)
+        self.extension_length = extension_length
+        self.last_ring = None
+
+        self.next_level = 'steel'
+        self.next_tracks = set()
+
+        self.fog_factor = 0.04
+        self.twist_factor = 0.0
+        self.bend_time_factor = 0.0
+        self.bend_y_factor = 0.0
+
+        self.ts_steel = palette.tilesets['steel']
+        self.ts_rift = palette.tilesets['rift']
+        self.ts_flesh = palette.tilesets['flesh']
+        self.ts_level = self.ts_steel
+
+        self.seg_count = 20
+
+    def calc_types(self, count, allow_swervible, allow_passable=True, allow_tunnel=True):
+        "Returns an array with the NavType value of each tile of the next ring."
+
+        exits = numpy.array(self.last_ring.exits, dtype=numpy.int32).reshape(-1, 3)
+        old_count = len(self.last_ring.tiles)
+        if count > old_count and count / old_count == 3:
+            exits[:, 0] *= 3
+
+        elif old_count > count and old_count / count == 3:
+            # Each exit turns into three, next to each other
+            scaled = numpy.empty((len(exits), 3, 3), dtype=numpy.int32)
+            scaled[:, :, 0] = numpy.rint(exits[:, 0] / 3).astype(numpy.int32)[:, None] + (-1, 0, 1)
+            scaled[:, :, 1] = exits[:, 1, None] + (1, 0, 0)
+            scaled[:, :, 2] = exits[:, 2, None] + (0, 0, 1)
+            exits = scaled.reshape(-1, 3)
+
+        elif count != old_count:
+            if allow_tunnel and allow_passable:
+                return numpy.full(count, self.random.choices((PASSABLE, PASSABLE, TUNNEL))[0], dtype=numpy.int8)
+            elif allow_tunnel:
+                return numpy.full(count, TUNNEL, dtype=numpy.int8)
+            else:
+                return numpy.full(count, PASSABLE, dtype=numpy.int8)
+
+        # Slight chance of random passable tile
+        #fill = self.random.choices((IMPASSABLE, IMPASSABLE, IMPASSABLE, IMPASSABLE, PASSABLE))[0]
+        fill = self.random.choices((IMPASSABLE, IMPASSABLE, IMPASSABLE, IMPASSABLE, PASSABLE if allow_passable else TUNNEL))[0]
+        if IS_PASSABLE[fill]:
+            # Every exit leads somewhere already
+            return numpy.full(count, fill, dtype=numpy.int8)
+
+        # Each exit can change the tiles the next one looks at (up to 2 tiles
+        # to either side), and draws from self.random in order, so these have
+        # to be resolved one by one.  Most exits sit next to each other, so
+        # there are hardly any that could be done together.  A list is used
+        # since indexing single elements of a numpy array is slower.
+        types = [fill] * count
+        for i, sw_left, sw_right in exits.tolist():
+            i %= count
+            nt = types[i]
+            if IS_PASSABLE[nt]:
+                continue
+
+            left = types[i - 1]
+            right = types[(i + 1) % count]
+            left2 = types[(i - 2) % count]
+            right2 = types[(i + 2) % count]
+            sw_next = (nt == SWERVIBLE)
+
+            if (sw_next or sw_left) and IS_OPEN[left]:
+                continue
+
+            if (sw_next or sw_right) and IS_OPEN[right]:
+                continue
+
+            if sw_left and left == TUNNEL:
+                continue
+
+            if sw_right and right == TUNNEL:
+                continue
+
+            if sw_left >= 2 and IS_OPEN[left2]:
+                continue
+
+            if sw_right >= 2 and IS_OPEN[right2]:
+                continue
+
+            if sw_left and sw_next and left == SWERVIBLE and IS_OPEN[left2]:
+                continue
+
+            if sw_right and sw_next and right == SWERVIBLE and IS_OPEN[right2]:
+                continue
+
+            choices = []
+            if allow_swervible or allow_passable or sw_left:
+                choices.append(-1)
+            if allow_swervible or allow_passable or sw_right:
+                choices.append(1)
+            if sw_left and (allow_swervible or allow_passable):
+                choices.append(-2)
+            if sw_right and (allow_swervible or allow_passable):
+                choices.append(2)
+
+            choice = self.random.choice(choices) if choices else 0
+
+            if (choice < 0 and not sw_left) or (choice > 0 and not sw_right):
+                # To get to this one, need to swerve through the tile ahead
+                assert allow_swervible or allow_passable
+                if allow_swervible and nt != PASSABLE and nt != EMPTY:
+                    types[i] = SWERVIBLE
+                else:
+                    # we just have to make this one passable
+                    if nt != EMPTY:
+                        types[i] = PASSABLE
+                    continue
+                types[(i + choice) % count] = PASSABLE
+            else:
+                assert allow_tunnel or allow_passable
+                if allow_tunnel:
+                    types[(i + choice) % count] = TUNNEL
+                elif allow_passable:
+                    types[(i + choice) % count] = PASSABLE
+                else:
+                    types[(i + choice) % count] = EMPTY
+
+            if abs(choice) == 2:
+                # To get to this one, the one between it must also be swervible
+                assert allow_swervible or allow_passable
+                assert types[(i + choice // 2) % count] != TUNNEL
+                types[(i + choice // 2) % count] = SWERVIBLE
+
+        return numpy.array(types, dtype=numpy.int8)
+
+    def gen_tube(self, level):
+        if level == 'steel':
+            yield from self.gen_steel_level()
+
+        if level != 'flesh':
+            yield from self.gen_rift_level()
+
+        yield from self.gen_flesh_level()
+
+    def gen_steel_level(self):
+        self.fog_factor = 0.008
+        self.twist_factor = 0.0
+        self.bend_time_factor = 0.0
+        self.bend_y_factor = 0.0002
+        self.next_level = 'steel'
+
+        self.seg_count = 60
+        self.ts_level = self.ts_steel
+        self.next_tracks = set(['peace'])
+        yield self.gen_empty_ring()
+        yield from self.gen_obstacle_section()
+        yield from self.gen_wall_section(2)
+        yield from self.gen_tile_section(1)
+
+        yield from self.gen_trench()
+        self.next_tracks.add('peace')
+
+        yield self.gen_empty_ring(delta=10)
+        yield from self.gen_random_section()
+
+        self.next_tracks.add('space_big')
+        yield self.gen_empty_ring(delta=30)
+        yield self.gen_empty_ring(delta=60)
+        yield self.gen_empty_ring(delta=30)
+        yield from self.gen_random_section()
+        yield from self.gen_tile_section(3)
+        yield from self.gen_random_section()
+        yield from self.gen_random_section()
+        yield from self.gen_trench()
+        yield from self.gen_tile_section(1)
+        self.next_tracks.discard('space_big')
+        yield self.gen_passable_ring()
+        self.next_tracks.discard('peace')
+
+        self.next_tracks.add('tight')
+        yield from self.gen_transition(6)
+        yield from self.gen_wall_section()
+
+    def gen_rift_level(self):
+        self.fog_factor = 0.008
+        self.twist_factor = 0.0
+        self.bend_time_factor = 0.0
+        self.bend_y_factor = 0.0002
+        self.next_level = 'rift'
+
+        self.seg_count = 6
+        self.ts_level = self.ts_rift
+        self.next_tracks = set(['tight', 'medium'])
+        yield self.gen_empty_ring(delta=10)
+
+        yield self.gen_passable_ring(delta=3)
+        yield self.gen_passable_ring(delta=3)
+        yield self.gen_passable_ring(delta=3)
+        yield self.gen_passable_ring(delta=3)
+        yield self.gen_passable_ring(delta=3)
+        yield self.gen_passable_ring(delta=3)
+
+        yield from self.gen_trench()
+
+        self.next_tracks = set(['peace', 'drive'])
+
+        self.next_tracks.add('space_big')
+        yield self.gen_empty_ring(delta=30)
+        yield self.gen_empty_ring(delta=60)
+        yield self.gen_empty_ring(delta=30)
+        yield from self.gen_tile_section(3)
+        yield from self.gen_tile_section(1)
+        yield self.gen_empty_ring(delta=3)
+        yield from self.gen_trench(length=10)
+        self.next_tracks.discard('space_big')
+        yield self.gen_empty_ring()
+        self.next_tracks.discard('peace')
+
+        self.next_tracks.add('tight')
+        yield from self.gen_transition(12)
+        yield from self.gen_tile_section(1)
+        yield from self.gen_tile_section()
+        yield from self.gen_tile_section()
+
+    def gen_flesh_level(self):
+        # Always start with empty
+        self.next_level = 'flesh'
+        self.seg_count = 12
+        yield self.gen_empty_ring(ts=self.ts_rift)
+
+        self.next_tracks.discard('tight')
+        self.next_tracks.add('space')
+        self.next_tracks.add('drive')
+
+        self.fog_factor = 0.04
+        self.twist_factor = 5.0
+        self.bend_time_factor = 0.0003
+        self.bend_y_factor = 0.0002
+
+        ts = self.ts_flesh
+        self.ts_level = ts
+
+        # mouth... ewww
+        self.seg_count = 200
+        #yield self.gen_empty_ring()
+        gravity = 0.7
+        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 100, override_gravity=gravity)
+        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 40, override_gravity=gravity)
+        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 15, override_gravity=gravity)
+        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 6, override_gravity=gravity)
+        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 3, override_gravity=gravity)
+
+        self.next_tracks.discard('space')
+        self.next_tracks.discard('drive')
+        self.next_tracks.add('ambient')
+
+        ring = self.last_ring
+        ring.exits.append((self.random.randrange(0, 3), 0, 0))
+
+        #yield from self.gen_tile_section()
+        #yield from self.gen_tile_section()
+
+        # stomach or something ew
+        ring = self.gen_empty_ring(delta=-self.seg_count + 3, override_gravity=1)
+        ring.shader_end_radius = 1
+        yield ring
+        self.seg_count = 40
+        yield self.gen_empty_ring(override_gravity=1)
+        yield self.gen_passable_ring(override_gravity=1)
+        yield from self.gen_tile_section()
+        yield from self.gen_tile_section()
+        yield self.gen_passable_ring(delta=-3)
+        self.next_tracks.add('drive')
+        yield from self.gen_transition(6)
+
+        yield from self.gen_tile_section()
+        yield self.gen_passable_ring(delta=3)
+        yield from self.gen_tile_section()
+        yield self.gen_passable_ring(delta=-3)
+
+        yield self.gen_empty_ring(delta=100, override_gravity=0.0)
+        ring = self.gen_empty_ring()
+        ring.event = 'endgame'
+        yield ring
+
+        while True:
+            yield from self.gen_tile_section(override_gravity=0.0)
+
+    def gen_transition(self, to_segs, ts=None):
+        ts = ts or self.ts_level
+        transition_ts = self.ts_steel if ts is self.ts_rift else ts
+
+        seg1 = transition_ts.segments['tile1_transition']
+        seg2 = transition_ts.segments['tile1_transition_impassable']
+        segs = [seg1, seg2, seg2] * (int(ceil(self.seg_count // 3)))
+        ring = self.gen_ring(segs)
+        ring.end_depth = 3.0
+
+        # Continues into the distance, past where the branches start
+        options = [ts.segments[seg] for seg in ts.segments if 'tile1' in seg]
+        ring.extension = [array('H', self.random.choices(options, k=ring.count)) for i in range(self.extension_length)]
+        ring.extension_skip = 1
+        yield ring
+
+        self.seg_count = to_segs
+
+        # Every tile after tunnel should be passable but not a tunnel
+        options = [transition_ts.segments[seg] for seg in transition_ts.segments if 'tile1_passable_gate' in seg or 'tile1_passable_obstacle' in seg]
+        segs = self.random.choices(options, k=to_segs)
+        ring = self.gen_ring(segs)
+        ring.branch = True
+
+        for i in range(to_segs):
+            ring.exits.append((i, 1, 1))
+
+        yield ring
+
+    def gen_random_section(self):
+        width = self.random.choice(('wall', 'obstacle', 1, 3))
+        if width == 'wall':
+            yield from self.gen_wall_section()
+        elif width == 'obstacle':
+            yield from self.gen_obstacle_section()
+        else:
+            yield from self.gen_tile_section(width)
+
+    def gen_tile_section(self, width=None, ts=None, override_gravity=None):
+        if width is None:
+            width = self.random.choice((1, 3))
+
+        ts = self.ts_level
+
+        if len(ts.tile1_by_type[NavType.PASSABLE]) == 0:
+            width = 3
+
+        count = int(ceil(self.seg_count / width))
+
+        tiles = ts.tile3_by_type if width == 3 else ts.tile1_by_type
+        tiles_by_value = [tiles[nt] for nt in NavType]
+        allow_tunnel = len(tiles[NavType.TUNNEL]) > 0
+
+        for j in range(SECTION_LENGTH):
+            types = self.calc_types(count, allow_swervible=True, allow_tunnel=allow_tunnel)
+            segs = [self.random.choice(tiles_by_value[next_type]) for next_type in types.tolist()]
+
+            ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
+            ring.types = types
+
+            # Can't swerve out of a tunnel
+            passable = types == PASSABLE
+            exits = numpy.flatnonzero(passable | (types == TUNNEL))
+            ring.exits = numpy.column_stack((
+                exits,
+                (passable & numpy.roll(passable, 1))[exits],
+                (passable & numpy.roll(passable, -1))[exits],
+            )).tolist()
+            yield ring
+
+    def gen_obstacle_section(self, length=SECTION_LENGTH, ts=None):
+        ts = ts or self.ts_level
+        count = self.seg_count
+
+        for j in range(length):
+            types = self.calc_types(count, allow_swervible=True, allow_tunnel=False)
+
+            exits = []
+            segs = []
+            for i, nt in enumerate(types.tolist()):
+                if nt == IMPASSABLE or nt == SWERVIBLE:
+                    segs.append(ts.segments[self.random.choice(('tile1_passable_obstacle_3', 'tile1_passable_obstacle_4'))])
+                else:
+                    segs.append(ts.segments[self.random.choice(('tile1_empty', 'tile1_empty.001'))])
+                    exits.append((i, 2, 2))
+
+            ring = self.gen_ring(segs)
+            ring.types = types
+            ring.exits = exits
+            yield ring
+
+    def gen_wall_section(self, length=SECTION_LENGTH, ts=None):
+        ts = ts or self.ts_level
+        count = self.seg_count
+
+        for j in range(length):
+            types = self.calc_types(count, allow_swervible=True, allow_tunnel=False)
+
+            exits = []
+            segs = []
+            for i, nt in enumerate(types.tolist()):
+                if nt == IMPASSABLE or nt == SWERVIBLE:
+                    segs.append(ts.segments['tile1_swervible_wall_1'])
+                elif nt == EMPTY or self.random.getrandbits(1):
+                    segs.append(ts.segments['tile1_empty'])
+                    exits.append((i, 4, 4))
+                else:
+                    segs.append(ts.segments['tile1_passable_gate_1'])
+                    exits.append((i, 4, 4))
+
+            ring = self.gen_ring(segs)
+            ring.types = types
+            ring.exits = exits
+            yield ring
+
+    def gen_passable_ring(self, delta=0, ts=None, override_gravity=None):
+        ts = ts or self.ts_level
+
+        tiles = ts.tile1_by_type[NavType.PASSABLE]
+        width = 1
+        if not tiles:
+            tiles = ts.tile3_by_type[NavType.PASSABLE]
+            width = 3
+
+        segs = self.random.choices(tiles, k=int(ceil((self.seg_count + delta) / width)))
+        ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
+
+        for i in range(len(segs)):
+            ring.exits.append((i, 1, 1))
+
+        return ring
+
+    def gen_empty_ring(self, delta=0, ts=None, override_gravity=None):
+        ts = ts or self.ts_level
+
+        if ts.tile1_by_type[NavType.EMPTY]:
+            segs = self.random.choices(ts.tile1_by_type[NavType.EMPTY], k=max(1, self.seg_count + delta))
+            width = 1
+        else:
+            segs = self.random.choices(ts.tile3_by_type[NavType.EMPTY], k=int(ceil((self.seg_count + delta) / 3)))
+            width = 3
+
+        ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
+
+        for i in range(len(segs)):
+            ring.exits.append((i, 4, 4))
+
+        return ring
+
+    def gen_trench(self, length=SECTION_LENGTH, ts=None):
+        ts = ts or self.ts_level
+
+        if not ts.entrance_trenches or not ts.middle_trenches:
+            return
+
+        self.next_tracks.discard('peace')
+        self.next_tracks.discard('tight')
+        self.next_tracks.add('medium')
+
+        types = self.calc_types(self.seg_count // 3, allow_swervible=False, allow_passable=False, allow_tunnel=True)
+        exits = [(i, 0, 0) for i in numpy.flatnonzero(types == TUNNEL).tolist()]
+        tunnels = (types == TUNNEL).tolist()
+
+        segs = [self.random.choice(ts.entrance_trenches if tunnel else ts.impassable_trenches) for tunnel in tunnels]
+        ring = self.gen_ring(segs, width=3)
+        ring.types = types
+        ring.exits = exits
+        ring.end_depth = TRENCH_DEPTH
+        yield ring
+
+        for i in range(length):
+            segs = [self.random.choice(ts.middle_trenches if tunnel else ts.impassable_trenches) for tunnel in tunnels]
+            ring = self.gen_ring(segs, width=3)
+            ring.types = types
+            ring.exits = exits
+            ring.start_depth = TRENCH_DEPTH
+            ring.end_depth = TRENCH_DEPTH
+            yield ring
+
+        self.next_tracks.discard('medium')
+        self.next_tracks.add('peace')
+
+        if ts.exit_trenches:
+            segs = [self.random.choice(ts.exit_trenches if tunnel else ts.impassable_trenches) for tunnel in tunnels]
+            ring = self.gen_ring(segs, width=3)
+            ring.types = types
+            ring.exits = exits
+            ring.start_depth = TRENCH_DEPTH
+            yield ring
+
+    def gen_ring(self, segs, width=1, override_gravity=None):
+        assert len(segs) > 0
+
+        ring = RingLayout(
+            segs,
+            width=width,
+            start_count=self.seg_count,
+            level=self.next_level,
+            level_params=(self.fog_factor, self.twist_factor, self.bend_time_factor, self.bend_y_factor),
+            play_tracks=tuple(self.next_tracks),
+            override_gravity=override_gravity,
+        )
+
+        self.last_ring = ring
+        self.seg_count = ring.count
+        return ring
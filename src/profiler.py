@@ -0,0 +1,163 @@
+"""Keeps rolling timings of the subsystems, for the overlay that ProfilerOverlay
+shows, and feeds the same numbers to PStats as collectors under App."""
+
+from panda3d.core import PStatCollector, TextNode
+from direct.showbase.DirectObject import DirectObject
+from direct.gui.OnscreenText import OnscreenText
+from collections import deque
+from functools import wraps
+import time
+
+
+# How many frames the overlay averages over, and how often it's redrawn
+PROFILER_FRAMES = 120
+PROFILER_REFRESH = 0.25
+
+# Key that shows or hides the overlay
+PROFILER_KEY = 'f3'
+
+# name: Section, in the order they're shown
+sections = {}
+
+
+class Section:
+    """Times a piece of code, used as a context manager.  The time is summed
+    over the frame, so that it may be entered any number of times."""
+
+    def __init__(self, name):
+        self.name = name
+        self.collector = PStatCollector("App:" + name)
+        self.elapsed = 0.0
+        self.history = deque(maxlen=PROFILER_FRAMES)
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.collector.start()
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.elapsed += time.perf_counter() - self.start_time
+        self.collector.stop()
+
+    def end_frame(self):
+        self.history.append(self.elapsed)
+        self.elapsed = 0.0
+
+
+def section(name):
+    "Returns the Section with the given name, creating it if needed."
+
+    sec = sections.get(name)
+    if sec is None:
+        sec = Section(name)
+        sections[name] = sec
+    return sec
+
+
+def timed(name):
+    "Decorator that counts the time spent in each call towards a section."
+
+    sec = section(name)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with sec:
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class Counter:
+    "A number that is summed over each frame, such as the simulation steps."
+
+    def __init__(self, name):
+        self.name = name
+        self.collector = PStatCollector(name)
+        self.count = 0
+        self.history = deque(maxlen=PROFILER_FRAMES)
+
+    def add(self, count):
+        self.count += count
+
+    def end_frame(self):
+        self.collector.set_level(self.count)
+        self.history.append(self.count)
+        self.count = 0
+
+
+steps = Counter("Simulation steps")
+
+
+class ProfilerOverlay(DirectObject):
+    "Shows the average and worst frame time of each section, toggled by a key."
+
+    def __init__(self, quality=None):
+        self.quality = quality
+        self.render_section = section("Render")
+        self.text = OnscreenText(
+            text='',
+            pos=(0.05, -0.1),
+            scale=0.045,
+            fg=(1, 1, 1, 1),
+            shadow=(0, 0, 0, 1),
+            align=TextNode.A_left,
+            font=loader.load_font('cmtt12'),
+            parent=base.a2dTopLeft,
+            mayChange=True,
+        )
+        self.text.hide()
+        self.refresh_time = 0.0
+
+        # The render happens in igLoop, which has sort 50
+        self.tasks = [
+            base.taskMgr.add(self.render_start_task, 'profiler render start', sort=49, priority=-100),
+            base.taskMgr.add(self.render_end_task, 'profiler render end', sort=51),
+        ]
+
+        self.accept(PROFILER_KEY, self.toggle)
+
+    def destroy(self):
+        self.ignore_all()
+        for task in self.tasks:
+            task.remove()
+        self.text.destroy()
+
+    def toggle(self):
+        if self.text.is_hidden():
+            self.text.show()
+            self.refresh()
+        else:
+            self.text.hide()
+
+    def render_start_task(self, task):
+        self.render_section.__enter__()
+        return task.cont
+
+    def render_end_task(self, task):
+        self.render_section.__exit__()
+
+        for sec in sections.values():
+            sec.end_frame()
+        steps.end_frame()
+
+        now = time.perf_counter()
+        if not self.text.is_hidden() and now - self.refresh_time >= PROFILER_REFRESH:
+            self.refresh()
+        return task.cont
+
+    def refresh(self):
+        self.refresh_time = time.perf_counter()
+
+        lines = [f"{'':20s} {'avg ms':>7s} {'max ms':>7s}"]
+        for sec in sections.values():
+            history = sec.history or (0.0,)
+            lines.append(f"{sec.name:20s} {sum(history) * 1000 / len(history):7.2f} {max(history) * 1000:7.2f}")
+
+        history = steps.history or (0,)
+        lines.append(f"{steps.name:20s} {sum(history) / len(history):7.1f} {max(history):7d}")
+        lines.append(f"{'Frame rate':20s} {base.clock.get_average_frame_rate():7.1f}")
+        if self.quality is not None:
+            lines.append(f"{'Quality tier':20s} {self.quality.tier.name:>7s}")
+        self.text.text = '\n'.join(lines)
@@ -0,0 +1,156 @@
+"""Watches the frame time and steps the graphics settings up or down through
+a list of quality tiers, so that the game keeps up on slower machines."""
+
+from panda3d.core import ConfigVariableString
+from direct.showbase.DirectObject import DirectObject
+from statistics import median
+
+
+# Frame rate that the governor tries to keep up
+TARGET_FRAME_RATE = 60
+
+# Seconds of frames to look at before deciding; the median is used, so that a
+# single hitch (such as when the tube is built) doesn't count
+QUALITY_WINDOW = 2.0
+
+# Go down a tier when the frame time is this far over the budget for one
+# window, or up a tier when it is this far under it for UPGRADE_WINDOWS
+# windows in a row.  The gap between the two keeps it from flip-flopping.
+DOWNGRADE_RATIO = 1.15
+UPGRADE_RATIO = 0.7
+UPGRADE_WINDOWS = 5
+
+# Every time a tier turns out too slow right after going up to it, wait this
+# many times longer before trying it again
+UPGRADE_BACKOFF = 2
+
+# Key that switches to the next tier by hand, which stops the adjusting
+QUALITY_KEY = 'f4'
+
+# Set to one of the tier names in settings.prc to stick to that tier
+quality_tier = ConfigVariableString('quality-tier', '', "Fixes the graphics quality tier; leave empty to adjust it to the frame rate.")
+
+
+class QualityTier:
+    __slots__ = 'name', 'msaa_samples', 'normal_maps', 'emission_maps', 'num_rings', 'star_density', 'step_time'
+
+    def __init__(self, name, msaa_samples, normal_maps, emission_maps, num_rings, star_density, step_time):
+        self.name = name
+        self.msaa_samples = msaa_samples
+        self.normal_maps = normal_maps
+        self.emission_maps = emission_maps
+        self.num_rings = num_rings
+        self.star_density = star_density
+        self.step_time = step_time
+
+    def __repr__(self):
+        return f"<QualityTier {self.name}>"
+
+
+# From lowest to highest; the highest has the settings the game was made with.
+# The lower tiers also take longer simulation steps, which the collisions sweep
+# so that the ship can't pass through thin walls.
+QUALITY_TIERS = (
+    QualityTier('minimal', msaa_samples=0, normal_maps=False, emission_maps=False, num_rings=14, star_density=0.25, step_time=1 / 30),
+    QualityTier('low', msaa_samples=0, normal_maps=False, emission_maps=True, num_rings=18, star_density=0.5, step_time=1 / 30),
+    QualityTier('medium', msaa_samples=2, normal_maps=True, emission_maps=True, num_rings=24, star_density=0.75, step_time=1 / 60),
+    QualityTier('high', msaa_samples=4, normal_maps=True, emission_maps=True, num_rings=30, star_density=1.0, step_time=1 / 60),
+)
+
+
+class QualityGovernor(DirectObject):
+    """Applies the current tier to the simplepbr pipeline, and sends a
+    'quality-changed' event with the tier for the rest of the game to follow.
+    With vsync on, the frame time can't drop below the budget, so it only goes
+    back up if the frame rate is allowed to run higher than the target."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.budget = 1.0 / TARGET_FRAME_RATE
+        self.frame_times = []
+        self.window_time = 0.0
+        self.fast_windows = 0
+        self.upgrade_windows = [UPGRADE_WINDOWS] * len(QUALITY_TIERS)
+        self.upgraded = False
+        self.frame_time = None # median of the last window
+
+        names = [tier.name for tier in QUALITY_TIERS]
+        fixed = quality_tier.get_value()
+        if fixed and fixed not in names:
+            print(f"Unknown quality-tier {fixed!r}, expected one of {', '.join(names)}; adjusting to the frame rate instead")
+            fixed = None
+
+        if fixed:
+            self.index = names.index(fixed)
+            self.task = None
+        else:
+            self.index = len(QUALITY_TIERS) - 1
+            self.task = base.taskMgr.add(self.update, 'quality governor', sort=52)
+
+        self.accept(QUALITY_KEY, self.cycle_tier)
+        self.apply()
+
+    @property
+    def tier(self):
+        return QUALITY_TIERS[self.index]
+
+    def destroy(self):
+        self.ignore_all()
+        if self.task:
+            self.task.remove()
+            self.task = None
+
+    def cycle_tier(self):
+        if self.task:
+            self.task.remove()
+            self.task = None
+
+        self.index = (self.index + 1) % len(QUALITY_TIERS)
+        print(f"Quality: {self.tier.name} (fixed)")
+        self.apply()
+
+    def set_tier(self, index):
+        self.upgraded = index > self.index
+        self.index = index
+        self.fast_windows = 0
+        print(f"Quality: {self.tier.name} (frame time {self.frame_time * 1000:.1f} ms)")
+        self.apply()
+
+    def apply(self):
+        tier = self.tier
+        if self.pipeline is not None:
+            self.pipeline.msaa_samples = tier.msaa_samples
+            self.pipeline.use_normal_maps = tier.normal_maps
+            self.pipeline.use_emission_maps = tier.emission_maps
+
+        messenger.send('quality-changed', [tier])
+
+    def update(self, task):
+        dt = base.clock.dt
+        self.frame_times.append(dt)
+        self.window_time += dt
+        if self.window_time < QUALITY_WINDOW:
+            return task.cont
+
+        self.frame_time = median(self.frame_times)
+        self.frame_times.clear()
+        self.window_time = 0.0
+
+        if self.frame_time > self.budget * DOWNGRADE_RATIO:
+            if self.index > 0:
+                if self.upgraded:
+                    # It was fine before we went up; try it less often
+                    self.upgrade_windows[self.index] *= UPGRADE_BACKOFF
+                self.set_tier(self.index - 1)
+
+        elif self.frame_time < self.budget * UPGRADE_RATIO:
+            self.upgraded = False
+            self.fast_windows += 1
+            if self.index + 1 < len(QUALITY_TIERS) and self.fast_windows >= self.upgrade_windows[self.index + 1]:
+                self.set_tier(self.index + 1)
+
+        else:
+            self.upgraded = False
+            self.fast_windows = 0
+
+        return task.cont
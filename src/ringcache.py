@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+
+
+def get_geom_bytes(np):
+    "Returns the number of bytes of vertex and index data below the node."
+
+    size = 0
+    for gnp in np.find_all_matches("**/+GeomNode"):
+        for geom in gnp.node().get_geoms():
+            size += geom.get_vertex_data().get_num_bytes()
+            for prim in geom.get_primitives():
+                if prim.is_indexed():
+                    size += prim.get_data_size_bytes()
+    return size
+
+
+class RingCache:
+    """Least-recently-used cache of the geometry that rings are built from,
+    bounded by the amount of vertex and index data it keeps alive, and
+    counting how often it had what was asked for."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = OrderedDict()
+
+        # Used by both the generator thread and the main thread
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, np):
+        size = get_geom_bytes(np)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            while self.entries and self.num_bytes + size > self.max_bytes:
+                old_np, old_size = self.entries.popitem(last=False)[1]
+                self.num_bytes -= old_size
+                self.evictions += 1
+
+            self.entries[key] = (np, size)
+            self.num_bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def __repr__(self):
+        return f"<RingCache {len(self.entries)} entries, {self.num_bytes // 1024} KiB, {self.hits} hits, {self.misses} misses, {self.evictions} evictions>"
@@ -0,0 +1,164 @@
+"""Lays out the tube for many seeds in a pool of processes, and checks that
+the ship can make it from each ring to the next.  Going from one ring to the
+next, the ship can move as far sideways as the exit it leaves through allows,
+into any tile that isn't impassable.  It can then swerve sideways through
+swervible tiles, and leaves the ring through any passable one."""
+
+from multiprocessing import Pool
+from statistics import median
+import json
+
+from .layout import LayoutGenerator, NavType
+
+
+# How many tiles the ship can swerve sideways within one ring
+SWERVE_TILES = 2
+
+# How many rings to check, if the tube hasn't ended by then
+MAX_RINGS = 500
+
+PASSABLE_TYPES = frozenset(nt.value for nt in NavType if nt.is_passable)
+SWERVIBLE_TYPES = frozenset(nt.value for nt in NavType if nt.is_swervible)
+IMPASSABLE = NavType.IMPASSABLE.value
+
+# Set in each worker process by init_worker
+worker_palette = None
+
+
+def swerve(types, entered, max_steps):
+    "Returns the tiles that can be reached sideways from the entered ones."
+
+    count = len(types)
+    reached = set(entered)
+    for i in entered:
+        if types[i] not in SWERVIBLE_TYPES:
+            continue
+
+        for step in (-1, 1):
+            j = i
+            for n in range(max_steps):
+                j = (j + step) % count
+                if types[j] not in SWERVIBLE_TYPES:
+                    break
+                reached.add(j)
+
+    return reached
+
+
+def analyze_seed(palette, seed, level='steel', ring_length=40.0, max_rings=MAX_RINGS):
+    """Lays out the tube for the given seed and follows the ship through it,
+    returning a dict of metrics.  A forced swerve is a ring that can't be
+    passed without swerving, and the reaction distance is the distance
+    between one forced swerve and the next."""
+
+    generator = LayoutGenerator(palette, seed).gen_tube(level)
+
+    reachable = None
+    exits = {}
+    prev_count = 0
+    num_rings = 0
+    dead_end = None
+    forced_swerves = []
+    min_open_fraction = 1.0
+
+    for index, ring in zip(range(max_rings), generator):
+        if ring.types is not None:
+            types = ring.types.tolist()
+        else:
+            types = [palette.nav_types[id] for id in ring.tiles]
+        count = len(types)
+        num_rings += 1
+
+        if reachable is None or ring.branch:
+            # Anywhere goes at the start of the tube or of a new branch
+            entered = {j for j in range(count) if types[j] != IMPASSABLE}
+            straight = True
+        else:
+            entered = set()
+            straight = False
+            for i in reachable:
+                # The tiles overlapping this one, if the tile count changed
+                lo = i * count // prev_count
+                hi = -(-(i + 1) * count // prev_count)
+                straight = straight or any(types[j % count] in PASSABLE_TYPES for j in range(lo, hi))
+
+                sw_left, sw_right = exits.get(i, (0, 0))
+                for j in range(lo - sw_left, hi + sw_right):
+                    if types[j % count] != IMPASSABLE:
+                        entered.add(j % count)
+
+        reachable = {j for j in swerve(types, entered, SWERVE_TILES) if types[j] in PASSABLE_TYPES}
+        if not reachable:
+            dead_end = index
+            break
+
+        if not straight:
+            forced_swerves.append(index)
+
+        min_open_fraction = min(min_open_fraction, len(reachable) / count)
+        exits = {i: (sw_left, sw_right) for i, sw_left, sw_right in ring.exits}
+        prev_count = count
+
+        if ring.event == 'endgame':
+            break
+
+    gaps = [(b - a) * ring_length for a, b in zip(forced_swerves, forced_swerves[1:])]
+    return {
+        'seed': seed,
+        'solvable': dead_end is None,
+        'dead_end': dead_end,
+        'rings': num_rings,
+        'forced_swerves': len(forced_swerves),
+        'min_reaction_distance': min(gaps) if gaps else None,
+        'min_open_fraction': min_open_fraction,
+    }
+
+
+def init_worker(palette):
+    global worker_palette
+    worker_palette = palette
+
+
+def analyze_worker(args):
+    return analyze_seed(worker_palette, *args)
+
+
+def analyze_seeds(palette, seeds, level='steel', ring_length=40.0, max_rings=MAX_RINGS, processes=None):
+    "Analyzes the given seeds in a process pool, yielding the results in order."
+
+    jobs = ((seed, level, ring_length, max_rings) for seed in seeds)
+    with Pool(processes, initializer=init_worker, initargs=(palette,)) as pool:
+        yield from pool.imap(analyze_worker, jobs, chunksize=64)
+
+
+def summarize(results, num_hardest=10):
+    "Prints the totals over all results, and the hardest solvable seeds."
+
+    unsolvable = [result for result in results if not result['solvable']]
+    solvable = [result for result in results if result['solvable']]
+
+    print(f"{len(results)} seeds, {len(unsolvable)} unsolvable")
+    for result in unsolvable[:num_hardest]:
+        print(f"  seed {result['seed']}: dead end at ring {result['dead_end']}")
+
+    if not solvable:
+        return
+
+    swerves = [result['forced_swerves'] for result in solvable]
+    distances = [result['min_reaction_distance'] for result in solvable if result['min_reaction_distance'] is not None]
+    print(f"forced swerves:        min {min(swerves)}, median {median(swerves)}, max {max(swerves)}")
+    if distances:
+        print(f"min reaction distance: min {min(distances):.0f}, median {median(distances):.0f}, max {max(distances):.0f}")
+
+    def difficulty(result):
+        distance = result['min_reaction_distance']
+        return (distance if distance is not None else float('inf'), -result['forced_swerves'])
+
+    print("hardest seeds:")
+    for result in sorted(solvable, key=difficulty)[:num_hardest]:
+        print(f"  seed {result['seed']}: {result['forced_swerves']} forced swerves, reaction distance {result['min_reaction_distance']}, narrowest {result['min_open_fraction']:.2f}")
+
+
+def save_results(path, results, **meta):
+    with open(path, 'w') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=2)
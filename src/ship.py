@@ -1,13 +1,19 @@
 from panda3d.core import NodePath, CardMaker, SamplerState
-from panda3d.core import ColorBlendAttrib, TransparencyAttrib
+from panda3d.core import ColorBlendAttrib, TransparencyAttrib, ColorWriteAttrib
 from panda3d.core import Point3, Vec4
+from panda3d.core import GeomNode, Geom, GeomTriangles, GeomVertexData
+from panda3d.core import GeomVertexArrayFormat, GeomVertexFormat, GeomEnums
 
 from direct.showbase.DirectObject import DirectObject
 from direct.interval.IntervalGlobal import Sequence, Wait, Func, LerpFunc
-from direct.motiontrail.MotionTrail import MotionTrail
 from direct.gui.OnscreenText import OnscreenText
 from direct.actor.Actor import Actor
 from random import random
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy
+
+from .profiler import timed
 
 
 CAM_TRAIL = 1.5 # units
@@ -33,6 +39,31 @@ REWIND_WAIT = 2.0
 # with higher value, will play big bounce sound only at higher vertical speeds
 BOUNCE_LARGE_THRESHOLD = 1.0
 
+# initial number of samples the PathHistory can hold before it has to grow
+HISTORY_CAPACITY = 1024
+
+# how far back to remember the trail, so it can be rebuilt when rewinding
+TRAIL_HISTORY_DIST = REWIND_DIST + 5.0
+
+# seconds of movement that the trail is made of
+TRAIL_TIME_WINDOW = 0.4
+
+# cross-section of the trail below the ship, with the color of each vertex
+TRAIL_VERTICES = (
+    ((-0.11, 0.00, -0.05), (0, 0, 0, 0)),
+    ((-0.08, 0.00, -0.05), (1, 0, 1, 1)),
+    ((-0.05, 0.00, -0.05), (0, 0, 0, 0)),
+    ((-0.00, 0.00, -0.05), (0, 0, 0, 0)),
+    (( 0.05, 0.00, -0.05), (0, 0, 0, 0)),
+    (( 0.08, 0.00, -0.05), (1, 0, 1, 1)),
+    (( 0.11, 0.00, -0.05), (0, 0, 0, 0)),
+)
+
+trail_array_format = GeomVertexArrayFormat()
+trail_array_format.add_column("vertex", 3, GeomEnums.NT_float32, GeomEnums.C_point)
+trail_array_format.add_column("color", 4, GeomEnums.NT_float32, GeomEnums.C_color)
+trail_format = GeomVertexFormat.register_format(trail_array_format)
+
 
 def smoothstep(x):
     x = max(0, min(x, 1))
@@ -40,119 +71,253 @@ def smoothstep(x):
 
 
 class ShipTrail:
+    """Ribbons of light behind the ship, built from where it was over the last
+    TRAIL_TIME_WINDOW seconds.  Where it was is kept in a PathHistory along the
+    tube for a while longer, so that the trail can be cut back when rewinding."""
+
     def __init__(self, ship, parent=None):
         self.parent = parent or base.render
         self.ship = ship
-        self.trail = MotionTrail("ship", self.ship)
-        taskMgr.remove(self.trail.motion_trail_task_name)
-        self.trail.time_window = 0.4 # Length of trail
-        self.trail.resolution_distance = 0.00001
-        self.trail.register_motion_trail()
-        #self.trail.set_depth_test(False)
-        self.trail.geom_node_path.reparent_to(self.parent)
-        self.trail.geom_node_path.node().set_attrib(
+        self.time_window = TRAIL_TIME_WINDOW
+
+        self.vertices = numpy.array([pos + (1,) for pos, col in TRAIL_VERTICES])
+        self.colors = numpy.array([col for pos, col in TRAIL_VERTICES])
+
+        self.geom_node = GeomNode("ship_trail")
+        self.geom_node_path = self.parent.attach_new_node(self.geom_node)
+        self.geom_node_path.set_two_sided(True)
+        self.geom_node_path.set_transparency(True)
+        self.geom_node_path.set_depth_write(False)
+        self.geom_node_path.set_light_off()
+        self.geom_node_path.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_rgb))
+        self.geom_node_path.node().set_attrib(
             ColorBlendAttrib.make(
                 ColorBlendAttrib.M_add,
                 ColorBlendAttrib.O_incoming_alpha,
                 ColorBlendAttrib.O_one
             )
         )
-        for v, pc in enumerate((
-            (Point3(-0.11,  0.00, -0.05),Vec4(0,0,0,0)),
-            (Point3(-0.08,  0.00, -0.05),Vec4(1,0,1,1)),
-            (Point3(-0.05,  0.00, -0.05),Vec4(0,0,0,0)),
-            (Point3(-0.00,  0.00, -0.05),Vec4(0,0,0,0)),
-            (Point3( 0.05,  0.00, -0.05),Vec4(0,0,0,0)),
-            (Point3( 0.08,  0.00, -0.05),Vec4(1,0,1,1)),
-            (Point3( 0.11,  0.00, -0.05),Vec4(0,0,0,0)),
-        )):
-            pos, col = pc
-            self.trail.add_vertex(pos)
-            self.trail.set_vertex_color(v, col, col)
-        self.accum_dt = 0
-        self.trail.update_vertices()
-
-    def update(self, tube_y, x=0, off=(0, 0, 0)):
-        self.accum_dt += base.clock.dt
+        self.time = 0.0
+
+        # Frames by y, each an array of the time followed by the vertices
+        # relative to the parent
+        self.history = PathHistory(TRAIL_HISTORY_DIST)
+
+        # Triangles are the same for the same number of frames
+        self.triangles = {}
+
+        # The one geom is rewritten for every new frame
+        vdata = GeomVertexData("ship_trail", trail_format, GeomEnums.UH_stream)
+        vdata.set_num_rows(2 * len(self.vertices))
+        geom = Geom(vdata)
+        geom.add_primitive(self.get_triangles(2))
+        self.geom_node.add_geom(geom)
+        self.num_frames = 2
+        self.geom_node_path.hide()
+
+        # The geometry is made once a frame, however many steps were run
+        self.dirty = False
+        self.task = base.taskMgr.add(self.build_task, sort=5)
+
+    def update(self, tube_y, dt, x=0, off=(0, 0, 0)):
+        self.time += dt
+        self.add_frame(tube_y, x, off)
+
+    def rewind(self, tube_y):
+        """Cuts the trail back to the given point, turning its clock back to
+        when the ship passed there, and continues it from the ship's current
+        transform."""
+
+        if len(self.history):
+            self.time = self.history.rewind(tube_y)[0]
+        self.add_frame(tube_y)
+
+    def add_frame(self, tube_y, x=0, off=(0, 0, 0)):
         transform = self.ship.get_transform(self.parent).get_mat()
         transform = transform * transform.translate_mat(x,tube_y,0)
-        self.trail.geom_node_path.set_pos(Point3(-x, -tube_y, 0) + off)
-        self.trail.transferVertices()
-        self.trail.cmotion_trail.updateMotionTrail(self.accum_dt, transform)
+        self.geom_node_path.set_pos(Point3(-x, -tube_y, 0) + off)
+
+        vertices = self.vertices @ numpy.array(transform)
+        self.history.append(tube_y, numpy.append(self.time, vertices[:, :3]))
+        self.dirty = True
+
+    @timed("ShipTrail.build_geometry")
+    def build_task(self, task):
+        if self.dirty:
+            self.dirty = False
+            self.build_geometry()
+
+        return task.cont
+
+    def build_geometry(self):
+        "Makes the trail out of the frames within the time window."
+
+        history = self.history
+        frames = history.values
+        min_time = self.time - self.time_window
+        start = history.end - 1
+        while start > history.start and frames[start - 1][0] >= min_time:
+            start -= 1
+
+        num_frames = history.end - start
+        if num_frames < 2:
+            self.geom_node_path.hide()
+            return
+
+        frames = numpy.array(frames[start:history.end], dtype=numpy.float32)
+        times = frames[:, 0]
+        t = (times - times[0]) / max(times[-1] - times[0], 1e-6)
+        rows = numpy.empty((num_frames, len(self.vertices), 7), dtype=numpy.float32)
+        rows[:, :, :3] = frames[:, 1:].reshape(num_frames, -1, 3)
+        numpy.multiply(self.colors, (t * t)[:, None, None], out=rows[:, :, 3:])
+
+        # Going through the node marks its bounds as stale
+        geom = self.geom_node.modify_geom(0)
+        vdata = geom.modify_vertex_data()
+        vdata.unclean_set_num_rows(rows.shape[0] * rows.shape[1])
+        memoryview(vdata.modify_array(0)).cast('B').cast('f')[:] = rows.ravel()
+
+        if num_frames != self.num_frames:
+            geom.set_primitive(0, self.get_triangles(num_frames))
+            self.num_frames = num_frames
+        self.geom_node_path.show()
+
+    def get_triangles(self, num_frames):
+        "Returns two triangles between every pair of frames and pair of vertices."
+
+        tris = self.triangles.get(num_frames)
+        if tris is not None:
+            return tris
+
+        num_vertices = len(self.vertices)
+        quads = (numpy.arange(num_frames - 1)[:, None] * num_vertices + numpy.arange(num_vertices - 1)).ravel()
+        quads = quads[:, None] + numpy.array([0, 1, num_vertices, 1, num_vertices + 1, num_vertices])
+
+        tris = GeomTriangles(GeomEnums.UH_static)
+        tris.set_index_type(GeomEnums.NT_uint16)
+        tris_array = tris.modify_vertices()
+        tris_array.unclean_set_num_rows(quads.size)
+        memoryview(tris_array).cast('B').cast('H')[:] = quads.astype(numpy.uint16).ravel()
+        self.triangles[num_frames] = tris
+        return tris
 
     def reset(self):
-        self.trail.reset_motion_trail()
-        self.trail.reset_motion_trail_geometry()
+        self.geom_node_path.hide()
+        self.history = PathHistory(TRAIL_HISTORY_DIST)
+
+    def rebase(self, shift):
+        "Moves the trail back along with the tube, when the tube origin moves."
+
+        history = self.history
+        history.shift(shift)
+        for i in range(history.start, history.end):
+            history.values[i][2::3] -= shift
+
+        self.geom_node_path.set_y(self.geom_node_path.get_y() + shift)
+        self.dirty = True
 
     def destroy(self):
+        self.task.remove()
         self.reset()
-        self.trail.geom_node_path.remove_node()
-        self.trail.delete()
+        self.geom_node_path.remove_node()
 
 
 class PathHistory:
-    def __init__(self, max_length):
-        self.max_length = max_length
-        self.samples = []
+    """Keeps the ship's (r, z, h, tilt) over the last max_length units of tube.
+    The samples are kept in order in a preallocated array of times and a list
+    of values, which are only moved back to the start when the end is reached."""
 
-    def append(self, t, v):
-        while len(self.samples) > 0 and self.samples[-1][0] >= t:
-            self.samples.pop()
+    def __init__(self, max_length, capacity=HISTORY_CAPACITY):
+        self.max_length = max_length
+        self.times = array('d', bytes(capacity * 8))
+        self.values = [None] * capacity
+        self.start = 0
+        self.end = 0
 
-        while len(self.samples) > 2 and self.samples[1][0] < t - self.max_length:
-            self.samples.pop(0)
+    def __len__(self):
+        return self.end - self.start
 
-        self.samples.append((t, v))
+    def append(self, t, v):
+        times = self.times
+        start = self.start
+        end = self.end
+
+        # Drop everything at or after t
+        if end > start and times[end - 1] >= t:
+            end = bisect_left(times, t, start, end)
+
+        # Drop the samples that are too old, but keep the last one before it
+        cutoff = t - self.max_length
+        if end - start > 2 and times[start + 1] < cutoff:
+            start = min(bisect_left(times, cutoff, start + 1, end) - 1, end - 2)
+
+        # Out of room; move the samples back to the start, or grow if they
+        # would fill up more than half of it
+        if end == len(times):
+            values = self.values
+            count = end - start
+            if count * 2 > len(times):
+                self.times = array('d', bytes(len(times) * 16))
+                self.values = [None] * (len(times) * 2)
+            self.times[:count] = times[start:end]
+            self.values[:count] = values[start:end]
+            start = 0
+            end = count
+
+        self.times[end] = t
+        self.values[end] = v
+        self.start = start
+        self.end = end + 1
+
+    def shift(self, dt):
+        "Moves all samples back by the given amount, when the origin moves."
+
+        times = self.times
+        for i in range(self.start, self.end):
+            times[i] -= dt
+
+    def interpolate(self, i, t):
+        "Interpolates between sample i and the one after it."
+
+        t0 = self.times[i]
+        t1 = self.times[i + 1]
+        if t0 == t1:
+            return self.values[i]
+        else:
+            ti = (t - t0) / (t1 - t0)
+            return self.values[i] * (1 - ti) + self.values[i + 1] * ti
 
     def sample(self, t):
-        if t >= self.samples[-1][0]:
-            t, v = self.samples[-1]
-            return v
-
-        if self.samples[0][0] >= t:
-            t, v = self.samples[0]
-            return v
+        if t >= self.times[self.end - 1]:
+            return self.values[self.end - 1]
 
-        i = 0
-        while len(self.samples) > 2 and self.samples[i + 1][0] < t:
-            i += 1
+        if self.times[self.start] >= t:
+            return self.values[self.start]
 
-        t0, v0 = self.samples[i]
-        t1, v1 = self.samples[i + 1]
-        if t0 == t1:
-            return v0
-        else:
-            ti = (t - t0) / (t1 - t0)
-            return v0 * (1 - ti) + v1 * ti
+        i = bisect_left(self.times, t, self.start, self.end) - 1
+        return self.interpolate(i, t)
 
     def rewind(self, t):
         "Like sample, but also removes all samples after that point"
 
-        if t >= self.samples[-1][0]:
-            t, v = self.samples[-1]
-            return v
+        if t >= self.times[self.end - 1]:
+            return self.values[self.end - 1]
 
-        if self.samples[0][0] >= t:
-            if len(self.samples) > 1:
-                del self.samples[1:]
-            t, v = self.samples[0]
-            return v
+        if self.times[self.start] >= t:
+            self.end = self.start + 1
+            return self.values[self.start]
 
-        i = len(self.samples) - 2
-        while i >= 0 and self.samples[i][0] > t:
-            self.samples.pop()
-            i -= 1
-
-        t0, v0 = self.samples[i]
-        t1, v1 = self.samples[i + 1]
-        if t0 == t1:
-            v = v0
-        else:
-            ti = (t - t0) / (t1 - t0)
-            v = v0 * (1 - ti) + v1 * ti
+        # Keep the first sample after t, so we can interpolate towards it.
+        # Usually, we're only rewinding past the last sample.
+        i = self.end - 2
+        if self.times[i] > t:
+            i = bisect_right(self.times, t, self.start, i) - 1
+        v = self.interpolate(i, t)
+        self.end = i + 2
 
         # Replace last sample with what we just interpolated
-        self.samples[-1] = (t, v)
+        self.times[i + 1] = t
+        self.values[i + 1] = v
         return v
 
 
@@ -206,9 +371,14 @@ class Ship:
 
 
 class ShipControls(DirectObject):
-    def __init__(self, ship, tube):
+    def __init__(self, ship, tube, is_button_down=None):
         self.ship = ship
         self.tube = tube
+
+        # Defaults to the keyboard, but may be replaced with a scripted input
+        if is_button_down is None:
+            is_button_down = base.mouseWatcherNode.is_button_down
+        self.is_button_down = is_button_down
         self.cam_task = base.taskMgr.add(self.cam_move, sort=4)
 
         self.bounce_large = loader.load_sfx('assets/sfx/bump1.wav')
@@ -237,6 +407,12 @@ class ShipControls(DirectObject):
         self.history = PathHistory(max(CAM_TRAIL, REWIND_DIST))
         self.history.append(0, Vec4(0, base.camera.get_z(), 0, 0))
 
+        # The crash and rewind are played by the steps, not in real time
+        self.crash_ival = None
+        self.crash_t = 0.0
+
+        self.accept('tube-rebase', self.on_tube_rebase)
+
         try:
             self.static_tex = loader.load_texture("assets/static.mp4")
         except IOError:
@@ -262,10 +438,16 @@ class ShipControls(DirectObject):
         self.static_plane.hide()
 
     def destroy(self):
+        self.ignore_all()
+        self.crash_ival = None
         base.camera.wrt_reparent_to(render)
         self.cam_root.remove_node()
         self.cam_task.remove()
 
+    def on_tube_rebase(self, shift):
+        self.history.shift(shift)
+        self.ship.trail.rebase(shift)
+
     def get_ship_z_above_ground(self):
         return self.ship.ship.get_z() + self.tube.current_ring.radius_at(0.0)
 
@@ -291,7 +473,7 @@ class ShipControls(DirectObject):
 
         self.r_speed = hor * SHIP_DONK_FACTOR
 
-        self.update_ship_rotation(-hor, force=True)
+        self.update_ship_rotation(-hor, 0.0, force=True)
 
     def crash(self):
         self.tube.pause()
@@ -302,9 +484,6 @@ class ShipControls(DirectObject):
         def rewind(y):
             self.tube.set_y(y)
             r, z, h, tilt = self.history.rewind(self.tube.y)
-            #self.ship.root.set_r(r)
-            #self.ship.ship.set_h(h)
-            #self.ship.ship.set_r(tilt)
 
             current_ring = self.tube.current_ring
             radius = current_ring.radius_at(0.0) + current_ring.depth_at(0.0)
@@ -314,20 +493,17 @@ class ShipControls(DirectObject):
             self.z_target = z
             self.r_speed = 0
 
-            # Update motion trail
-            self.ship.trail.reset()
-            for t, (r, z, h, tilt) in self.history.samples:
-                if t < self.tube.y - 4.0:
-                    continue
-                self.ship.root.set_r(r)
-                self.ship.ship.set_h(h)
-                self.ship.ship.set_r(tilt)
-                self.ship.trail.update(t)
-
-        to_y = max(0, self.tube.y - REWIND_DIST)
+            # Put the ship back where it was, and cut the trail off there
+            self.ship.root.set_r(r)
+            self.ship.ship.set_h(h)
+            self.ship.ship.set_r(tilt)
+            self.ship.trail.rewind(self.tube.y)
+
+        to_y = max(self.tube.start_y, self.tube.y - REWIND_DIST)
         rewind_ival = LerpFunc(rewind, duration=REWIND_TIME, fromData=self.tube.y, toData=to_y, blendType='easeInOut')
         noop = lambda: None
-        Sequence(
+        self.crash_t = 0.0
+        self.crash_ival = Sequence(
             Func(self.ship.explode, 1.0),
             Wait(1.5),
             Func(self.static_plane.show),
@@ -340,15 +516,15 @@ class ShipControls(DirectObject):
             Func(self.static_plane.hide),
             Func(self.static_tex.stop if self.static_tex else noop),
             Func(self.tube.resume),
-        ).start()
+        )
 
-    def update_ship_rotation(self, hor, force=False):
+    def update_ship_rotation(self, hor, dt, force=False):
         target_h = self.r_speed * 60 / ROT_SPEED_LIMIT
         target_r = hor * SHIP_ROLL_ANGLE
         if force:
             t = 0.0
         else:
-            t = SHIP_ROLL_SPEED ** base.clock.dt
+            t = SHIP_ROLL_SPEED ** dt
         self.ship.ship.set_hpr(target_h, 0, target_r * (1 - t) + self.ship.ship.get_r() * t)
 
     def update(self, dt):
@@ -356,9 +532,15 @@ class ShipControls(DirectObject):
             #self.ship.trail.trail.geom_node_path.set_y(-self.tube.y)
             #self.ship.trail.update(self.tube.y)
             #self.ship.trail.update(self.tube.y)
+            if self.crash_ival is not None:
+                # Resumes the tube on a step, so it doesn't drift
+                self.crash_t += dt
+                self.crash_ival.set_t(self.crash_t)
+                if self.crash_t >= self.crash_ival.get_duration():
+                    self.crash_ival = None
             return
 
-        is_down = base.mouseWatcherNode.is_button_down
+        is_down = self.is_button_down
 
         current_ring = self.tube.current_ring
         #self.set_ship_z_target(SHIP_HEIGHT - max(current_ring.start_radius + current_ring.start_depth, current_ring.end_radius + current_ring.end_depth))
@@ -418,20 +600,31 @@ class ShipControls(DirectObject):
         r = self.ship.root.get_r() + self.r_speed * dt / -z
         self.ship.root.set_r(r)
 
-        self.update_ship_rotation(hor)
-        self.ship.trail.update(self.tube.y)
+        self.update_ship_rotation(hor, dt)
+        self.ship.trail.update(self.tube.y, dt)
+
+    def end_step(self):
+        "Records where the ship ended up, after Collisions had their say."
 
-    def cam_move(self, task):
-        # This happens after collisions, so that the camera doesn't clip
-        r = self.ship.root.get_r()
-        z = self.ship.ship.get_z()
-        h = self.ship.ship.get_h()
-        tilt = self.ship.ship.get_r()
         if not self.tube.paused:
-            self.history.append(self.tube.y, Vec4(r, z, h, tilt))
+            self.history.append(self.tube.y, self.get_state())
 
-        # Calculate ship r and z some distance ago
-        r, z, h, tilt = self.history.sample(self.tube.y - CAM_TRAIL)
+    def get_state(self):
+        "Returns the ship's r, z, h and tilt."
+
+        return Vec4(self.ship.root.get_r(), self.ship.ship.get_z(), self.ship.ship.get_h(), self.ship.ship.get_r())
+
+    def set_state(self, state):
+        r, z, h, tilt = state
+        self.ship.root.set_r(r)
+        self.ship.ship.set_z(z)
+        self.ship.ship.set_hpr(h, 0, tilt)
+
+    @timed("ShipControls.cam_move")
+    def cam_move(self, task):
+        # Calculate ship r and z some distance ago; the history is recorded
+        # after collisions, so that the camera doesn't clip
+        r, z, h, tilt = self.history.sample(self.tube.render_y - CAM_TRAIL)
 
         if z > self.ship.ship.get_z() + 0.5:
             z = self.ship.ship.get_z() + 0.5
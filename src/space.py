@@ -3,26 +3,27 @@ from panda3d.core import LineSegs, Vec3, Fog
 from random import uniform
 
 
+NUM_STARS = 2048
+
+
 class Starfield:
     def __init__(self):
-        segs = LineSegs("starfield")
         def randvec(n):
             return Vec3(uniform(-n,n), uniform(-n,n), uniform(-n,n))
 
-        for i in range(2048):
-            v = randvec(1000)
-            segs.set_color((1,1,1,1))
-            segs.move_to(v)
-            segs.draw_to(v+(0,2,0))
-            segs.set_color((0,1,1,0))
-
+        self.stars = [randvec(1000) for i in range(NUM_STARS)]
+        self.density = 1.0
 
+        # The same stars are instanced three times, one after the other
         fields = render.attach_new_node("fields")
-        field = fields.attach_new_node(segs.create())
-        field_2 = field.copy_to(field)
+        field = fields.attach_new_node("field")
+        self.stars_np = field.attach_new_node(self.make_stars(NUM_STARS))
+        field_2 = field.attach_new_node("field_2")
         field_2.set_y(2000)
-        field_3 = field.copy_to(field)
+        self.stars_np.instance_to(field_2)
+        field_3 = field.attach_new_node("field_3")
         field_3.set_y(4000)
+        self.stars_np.instance_to(field_3)
         field.posInterval(10, pos=(0,-2000,0)).loop()
         fields.set_h(-20)
 
@@ -33,5 +34,25 @@ class Starfield:
         fields.set_fog(fog)
         self.fields = fields
 
+    def make_stars(self, count):
+        segs = LineSegs("starfield")
+        for v in self.stars[:count]:
+            segs.set_color((1,1,1,1))
+            segs.move_to(v)
+            segs.draw_to(v+(0,2,0))
+            segs.set_color((0,1,1,0))
+        return segs.create()
+
+    def set_density(self, density):
+        "Draws only the given fraction of the stars."
+
+        if density == self.density:
+            return
+
+        self.density = density
+        node = self.stars_np.node()
+        node.remove_all_geoms()
+        node.add_geoms_from(self.make_stars(max(1, int(NUM_STARS * density))))
+
     def destroy(self):
         self.fields.remove_node()
@@ -0,0 +1,44 @@
+"""Keeps track of how long each phase of starting up the game takes.  Import
+this before anything else, since the clock starts when it's imported."""
+
+from contextlib import contextmanager
+import time
+
+
+start_time = time.perf_counter()
+
+# (name, start, duration), in seconds since start_time
+phases = []
+num_reported = 0
+
+
+@contextmanager
+def phase(name):
+    "Records how long the body of the with statement takes."
+
+    phase_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        phases.append((name, phase_start - start_time, now - phase_start))
+
+
+def milestone(name):
+    "Records a point in time, such as the title screen becoming visible."
+
+    phases.append((name, time.perf_counter() - start_time, None))
+
+
+def report(title="Startup timing"):
+    "Prints the phases and milestones recorded since the last report."
+
+    global num_reported
+
+    print(f"{title}:")
+    for name, start, duration in phases[num_reported:]:
+        if duration is None:
+            print(f"  {start * 1000:8.0f} ms  {name}")
+        else:
+            print(f"  {start * 1000:8.0f} ms  {name:32s} {duration * 1000:8.0f} ms")
+    num_reported = len(phases)
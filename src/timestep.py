@@ -0,0 +1,35 @@
+class FixedTimestep:
+    """Splits the frame time into steps of a fixed length, carrying what's left
+    over to the next frame, so that the simulation doesn't depend on the frame
+    rate.  alpha is how far the frame has gotten into the next step."""
+
+    def __init__(self, step_time, max_steps):
+        self.step_time = step_time
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+
+    def advance(self, dt):
+        "Adds the time of a frame, and returns how many steps to run for it."
+
+        self.accumulator += dt
+        num_steps = 0
+        while self.accumulator >= self.step_time:
+            if num_steps >= self.max_steps:
+                # Can't keep up; rather slow down than fall further behind
+                self.accumulator %= self.step_time
+                break
+
+            self.accumulator -= self.step_time
+            num_steps += 1
+
+        return num_steps
+
+    def set_step_time(self, step_time):
+        "Changes the step length, keeping how far the frame is into the step."
+
+        self.accumulator *= step_time / self.step_time
+        self.step_time = step_time
+
+    @property
+    def alpha(self):
+        return self.accumulator / self.step_time
@@ -69,5 +69,5 @@ class Title:
 
     def update(self, task):
         self.a += base.clock.dt
-        self.trails.update(self.a * 50, self.a * 15, (-0.25, -0.1, 0.6))
+        self.trails.update(self.a * 50, base.clock.dt, self.a * 15, (-0.25, -0.1, 0.6))
         return task.cont
@@ -2,18 +2,37 @@ from panda3d.core import (
     NodePath,
     Shader,
     ShaderAttrib,
-    OmniBoundingVolume,
+    BoundingBox,
+    BoundingVolume,
     NodePathCollection,
     CollisionPolygon,
     Vec2,
+    Thread,
+    Filename,
+    VirtualFileSystem,
+    MaterialAttrib,
+    get_model_path,
+    GeomEnums,
+    GeomVertexArrayFormat,
+    GeomVertexArrayData,
+    GeomVertexFormat,
+    GeomVertexData,
 )
 
+from array import array
+from collections import defaultdict, deque
 from random import Random
-from math import pi, tau, ceil, cos, sin
-from enum import Enum
+from queue import Queue, Empty, Full
+import threading
+import hashlib
+import time
+import numpy
+from math import pi, tau, ceil, cos, sin, log, inf
 
 from .gurgles import MultiTrack
-from .util import RingList
+from .ringcache import RingCache
+from .profiler import timed
+from .layout import NavType, TilePalette, LayoutGenerator
 
 
 LEVEL = 'steel'
@@ -27,24 +46,51 @@ MIN_SEG_COUNT = 6
 MAX_SWERVE = 6
 CULL_MARGIN = 5.0
 
-SECTION_LENGTH = 2
-TRENCH_DEPTH = 2.8
+# Once the rings have scrolled this far, move the origin back to the ship
+REBASE_DISTANCE = 25 * Y_SPACING
 
 
-class NavType(Enum):
-    EMPTY = 0
-    PASSABLE = 1
-    SWERVIBLE = 2 # sic
-    IMPASSABLE = 3
-    TUNNEL = 4 # non-swervable but passable
+# Generate and flatten rings on a worker thread, this many rings ahead
+THREADED_GENERATION = True
+LOOKAHEAD_RINGS = 4
 
-    @property
-    def is_passable(self):
-        return self in (NavType.EMPTY, NavType.PASSABLE, NavType.TUNNEL)
+# Draw each unique tile once per ring with a per-instance offset, rather than
+# copying and flattening the tile geometry for every segment
+INSTANCED_TILES = True
 
-    @property
-    def is_swervible(self): #sic
-        return self in (NavType.SWERVIBLE, NavType.PASSABLE, NavType.EMPTY)
+# Bytes of tile instancing templates to keep around, see Tube.get_tile_template
+RING_CACHE_SIZE = 16 * 1024 * 1024
+
+# Bump this when changing how TileSet.add processes the tiles, so that any
+# bakes of the segments model are made again
+BAKED_SEGMENTS_VERSION = 1
+
+# Index of each material in the baked collision profiles
+COLLISION_MATERIALS = 'steel', 'flesh'
+
+# How many culled rings to keep around for reuse, on top of NUM_RINGS
+RING_POOL_MARGIN = 8
+
+# Don't draw the rings that the fog has made darker than this all over, nor
+# attach more than one of them.  It's this low because tube.frag brightens the
+# emission by 240 times, and the sRGB framebuffer brightens dark colors more.
+FOG_CULLING = True
+FOG_CULL_ALPHA = 1e-6
+
+# As the fog and occlusion darken fragments from SHADING_LOD_FADE_ALPHA down to
+# SHADING_LOD_ALPHA, tube.frag fades out their normal map and specular
+# reflection, and skips them below that; the ones darker than FOG_CULL_ALPHA
+# aren't shaded at all
+SHADING_LOD_FADE_ALPHA = 0.08
+SHADING_LOD_ALPHA = 0.02
+
+# Extra room around the bounds of each ring, since the tube may be shown up to
+# a step behind where it is, see Tube.set_render_y
+BOUNDS_MARGIN = 1.0
+
+# How many of the most recently culled rings to keep intact, so that they can
+# be put back when rewinding after a crash
+RETAINED_RINGS = 3
 
 
 class TileSet:
@@ -69,7 +115,10 @@ class TileSet:
             NavType.TUNNEL: [],
         }
         self.tile3s = []
+        self.tiles = []
         self.segments = {}
+        self.profiles = {}
+        self.emissive = {}
 
     def add(self, n):
         name = n.name.split('_', 1)[1]
@@ -105,9 +154,19 @@ class TileSet:
 
         n.clear_transform()
         n.flatten_strong()
+        self.register(n, cnps)
+
+    def register(self, n, cnps):
+        "Adds a tile that has already been processed by add()."
+
+        name = n.name.split('_', 1)[1]
+
+        self.profiles[n.name] = make_collision_profile(cnps)
+        self.emissive[n.name] = has_emission(n)
 
         seg = (n, cnps)
         self.segments[name] = seg
+        self.tiles.append(seg)
 
         if name.startswith('trench3_entrance'):
             self.entrance_trenches.append(seg)
@@ -142,6 +201,76 @@ class TileSet:
         elif name.startswith('tile3_passable'):
             self.tile3_by_type[NavType.PASSABLE].append(seg)
 
+    def write_baked(self, parent):
+        "Stores the processed tiles under the given node, for read_baked()."
+
+        for n, cnps in self.tiles:
+            tile = parent.attach_new_node("tile")
+            n.instance_to(tile)
+            collisions = tile.attach_new_node("collisions")
+            for cnp in cnps:
+                cnp.instance_to(collisions)
+
+    def read_baked(self, parent):
+        "Adds the tiles stored by write_baked(), skipping all processing."
+
+        for tile in parent.children:
+            n, collisions = tile.children
+            cnps = list(collisions.children)
+            n.detach_node()
+            for cnp in cnps:
+                cnp.detach_node()
+            self.register(n, cnps)
+
+
+def make_tilesets(model):
+    "Returns the TileSet for each level, from the segments model or its bake."
+
+    tilesets = {name: TileSet(name) for name in LEVELS}
+
+    if model.name == "baked_segments":
+        for name, ts in tilesets.items():
+            ts.read_baked(model.find(name))
+    else:
+        for n in model.children:
+            prefix = n.name.split('_', 1)[0]
+            if prefix in tilesets:
+                tilesets[prefix].add(n)
+
+    return tilesets
+
+
+def get_baked_segments_path(path):
+    """Returns where the bake of the given segments model goes, which depends
+    on the contents of the model, or None if the model doesn't exist."""
+
+    vfs = VirtualFileSystem.get_global_ptr()
+    filename = Filename(path)
+    if not vfs.exists(filename):
+        return None
+
+    digest = hashlib.sha1(b'%d:' % BAKED_SEGMENTS_VERSION)
+    digest.update(vfs.read_file(filename, True))
+    return f"{path.rsplit('.', 1)[0]}-baked-{digest.hexdigest()[:16]}.bam"
+
+
+def find_baked_segments(path):
+    "Returns the path of an up-to-date bake of the segments model, if any."
+
+    baked_path = get_baked_segments_path(path)
+    if baked_path and VirtualFileSystem.get_global_ptr().exists(Filename(baked_path)):
+        return baked_path
+    return path
+
+
+def bake_segments(model, path):
+    "Processes the segments model, and writes the resulting TileSets to path."
+
+    root = NodePath("baked_segments")
+    for name, ts in make_tilesets(model).items():
+        ts.write_baked(root.attach_new_node(name))
+    root.write_bam_file(path)
+
 
 def should_cull_collision_poly(name, solid):
     if abs(solid.normal.z) > 0.7 or solid.normal.y > 0.2:
@@ -165,63 +294,354 @@ def should_cull_collision_poly(name, solid):
     return False
 
 
-shader = Shader.load(Shader.SL_GLSL, "assets/glsl/tube.vert", "assets/glsl/tube.frag")
+def make_collision_profile(cnps):
+    """Bakes the collision polygons that survived culling into an array with
+    one row per polygon: the plane, the bounding box, and the material index.
+    Returns it along with the bounding box of the whole tile."""
+
+    rows = []
+    for cnp in cnps:
+        mat = cnp.get_mat()
+        material = COLLISION_MATERIALS.index(cnp.get_tag("material"))
+        for solid in cnp.node().get_solids():
+            # Anything else is left to the CollisionTraverser path
+            if not isinstance(solid, CollisionPolygon):
+                continue
+
+            points = [mat.xform_point(point) for point in solid.points]
+            normal = mat.xform_vec(solid.normal).normalized()
+            rows.append((
+                normal.x, normal.y, normal.z, -normal.dot(points[0]),
+                min(p.x for p in points), min(p.y for p in points), min(p.z for p in points),
+                max(p.x for p in points), max(p.y for p in points), max(p.z for p in points),
+                material,
+            ))
+
+    if not rows:
+        return None
+
+    rows = numpy.array(rows, dtype=numpy.float32)
+    bounds = tuple(rows[:, 4:7].min(axis=0)) + tuple(rows[:, 7:10].max(axis=0))
+    return bounds, rows
+
+
+instance_array_format = GeomVertexArrayFormat()
+instance_array_format.add_column("instance_offset", 2, GeomEnums.NT_float32, GeomEnums.C_other)
+instance_array_format.set_divisor(1)
+instance_array_format = GeomVertexArrayFormat.register_format(instance_array_format)
+
+
+def has_emission(np):
+    "Returns True if any of the geometry has a material that glows."
+
+    for gnp in np.find_all_matches("**/+GeomNode"):
+        gnode = gnp.node()
+        for i in range(gnode.get_num_geoms()):
+            state = gnp.get_net_state().compose(gnode.get_geom_state(i))
+            attrib = state.get_attrib(MaterialAttrib)
+            if attrib is None or attrib.get_material() is None:
+                continue
+
+            emission = attrib.get_material().get_emission()
+            if emission[0] > 0 or emission[1] > 0 or emission[2] > 0:
+                return True
+
+    return False
+
+
+def make_instance_template(np):
+    "Returns a copy of the tile with an empty per-instance array on its geoms."
+
+    template = np.copy_to(NodePath("template"))
+    template.detach_node()
+
+    for gnp in template.find_all_matches("**/+GeomNode"):
+        gnode = gnp.node()
+        for i in range(gnode.get_num_geoms()):
+            geom = gnode.modify_geom(i)
+            vdata = geom.get_vertex_data()
+
+            format = GeomVertexFormat(vdata.get_format())
+            format.add_array(instance_array_format)
+            format = GeomVertexFormat.register_format(format)
+
+            # Shares the vertex arrays (and therefore the buffers) of the tile
+            new_vdata = GeomVertexData(vdata.get_name(), format, vdata.get_usage_hint())
+            for j in range(vdata.get_num_arrays()):
+                new_vdata.set_array(j, vdata.get_array(j))
+            geom.set_vertex_data(new_vdata)
+
+    return template
+
+
+def clear_geom_bounds(np):
+    """Empties the bounds of the flat tile geometry, which tube.vert bends into
+    a different shape, so that only the bounds of the ring count."""
+
+    for gnp in np.find_all_matches("**/+GeomNode"):
+        gnp.node().set_bounds(BoundingBox())
+
+
+def set_instance_offsets(np, offsets):
+    "Points the instanced geoms below the node at the given (x, y) offsets."
+
+    inst_array = GeomVertexArrayData(instance_array_format, GeomEnums.UH_static)
+    write_instance_offsets(np, inst_array, offsets)
+
+    for gnp in np.find_all_matches("**/+GeomNode"):
+        gnode = gnp.node()
+        for i in range(gnode.get_num_geoms()):
+            vdata = gnode.modify_geom(i).modify_vertex_data()
+            vdata.set_array(vdata.get_num_arrays() - 1, inst_array)
+
+    return inst_array
+
+
+def write_instance_offsets(np, inst_array, offsets):
+    "Overwrites the offsets in an existing instance array, in place."
+
+    num_instances = len(offsets) // 2
+    inst_array.unclean_set_num_rows(num_instances)
+    memoryview(inst_array).cast('B').cast('f')[:] = array('f', offsets)
+    np.set_instance_count(num_instances)
+
+
+def read_shader(path, defines={}):
+    "Returns the source of a shader, with the defines added after #version."
+
+    vfs = VirtualFileSystem.get_global_ptr()
+    filename = Filename(path)
+    vfs.resolve_filename(filename, get_model_path().value)
+    source = vfs.read_file(filename, True).decode()
+
+    # Nothing but comments may come before the #version line
+    lines = source.split('\n')
+    index = next(i for i, line in enumerate(lines) if line.startswith('#version')) + 1
+    lines[index:index] = [f"#define {name} {value}" for name, value in defines.items()]
+    return '\n'.join(lines)
+
+
+# (normal_maps, emission_maps): Shader
+tube_shaders = {}
+
+
+def get_tube_shader(normal_maps=True, emission_maps=True):
+    "Returns the permutation of the tube shader that uses the given maps."
+
+    key = (normal_maps, emission_maps)
+    shader = tube_shaders.get(key)
+    if shader is None:
+        defines = {
+            'SHADING_LOD_FADE_ALPHA': SHADING_LOD_FADE_ALPHA,
+            'SHADING_LOD_ALPHA': SHADING_LOD_ALPHA,
+            'SHADING_CULL_ALPHA': FOG_CULL_ALPHA,
+        }
+        if normal_maps:
+            defines['USE_NORMAL_MAP'] = 1
+        if emission_maps:
+            defines['USE_EMISSION_MAP'] = 1
+
+        shader = Shader.make(Shader.SL_GLSL, read_shader("assets/glsl/tube.vert"), read_shader("assets/glsl/tube.frag", defines))
+        tube_shaders[key] = shader
+    return shader
+
+
+shader = get_tube_shader()
+
+
+def fog_cull_distance(fog_factor):
+    "Returns the distance past which the fog makes things darker than FOG_CULL_ALPHA."
+
+    if not FOG_CULLING or fog_factor <= 0.0:
+        return inf
+    return -log(FOG_CULL_ALPHA) / fog_factor
 
 
 class Ring:
-    def __init__(self):
+    def __init__(self, scroll):
+        # The rings stay put, this node moves all of them past the ship
+        self.scroll = scroll
+
+        self.node_path = NodePath("ring")
+        self.node_path.node().set_final(True)
+        self.node_path.node().set_bounds_type(BoundingVolume.BT_box)
+
+        self.geom = None # flattened geometry, if not using INSTANCED_TILES
+        self.tile_geoms = {} # name: (node_path, instance array)
+        self.extension = None
+
+        # Attached to the collision scene graph by Collisions; per segment, a
+        # stashed node with the segment's collision nodes, and a solid count.
+        # Only made by add_collision_segments when the profiles aren't used.
+        self.collision_root = NodePath("ring_collisions")
+        self.collision_segments = []
+
+        self.reset()
+
+    def reset(self):
         self.collision_nodes = []
+        self.collision_profiles = []
         self.r_to_x = 1
         self.next_ring = None
         self.start_depth = 0.0
         self.end_depth = 0.0
-        self.exits = [] # i, sw_left, sw_right
         self.play_tracks = ()
         self.override_gravity = None
         self.event = None
+        self.inst_parent = None
+        self.branch_root = None
+        self.fog_distance = inf
+        self.emissive = False # whether any of the tiles glow
+
+        # Used by update_bounds: the radius shader input, the range of y that
+        # the tiles cover, the range of their depth, and how much the level
+        # bends the tube by the square of the distance
+        self.shader_radius = (0.0, 0.0)
+        self.y_extent = (0.0, 0.0)
+        self.z_extent = (0.0, 0.0)
+        self.bend_factor = 0.0
+
+        self.collision_root.detach_node()
+        self.collision_root.node().remove_all_children()
+        self.collision_segments = []
+
+        self.node_path.node().clear_attrib(ShaderAttrib)
+        self.node_path.show()
+        if self.extension is not None:
+            self.extension.remove_node()
+            self.extension = None
 
     @property
     def y(self):
-        return self.node_path.get_y()
+        return self.node_path.get_y() + self.scroll.get_y()
 
     @y.setter
     def y(self, y):
-        self.node_path.set_y(y)
+        self.node_path.set_y(y - self.scroll.get_y())
 
     def radius_at(self, y):
-        t = (y - self.node_path.get_y()) / Y_SPACING + 0.5
+        t = (y - self.y) / Y_SPACING + 0.5
         #t = max(0, min(1, t))
         return self.end_radius * t + self.start_radius * (1 - t)
 
     def depth_at(self, y):
-        t = (y - self.node_path.get_y()) / Y_SPACING + 0.5
+        t = (y - self.y) / Y_SPACING + 0.5
         #t = max(0, min(1, t))
         return self.end_depth * t + self.start_depth * (1 - t)
 
+    def add_collision_segments(self):
+        "Instances the collision nodes of each segment under collision_root."
+
+        if self.collision_segments:
+            return
+
+        for cnodes in self.collision_nodes:
+            if not cnodes:
+                self.collision_segments.append(None)
+                continue
+
+            seg_np = self.collision_root.attach_new_node("segment")
+            num_solids = 0
+            for cnode_path in cnodes:
+                cnode_path.instance_to(seg_np)
+                num_solids += cnode_path.node().get_num_solids()
+            seg_np.stash()
+            self.collision_segments.append((seg_np, num_solids))
+
+    def update_bounds(self):
+        """Sets the bounds of the ring to the shape that tube.vert bends the flat
+        tiles into, at the current distance.  Since the tube bends more further
+        away, this needs to be redone when the ring moves away, but not when it
+        comes closer.  The center of a branch is in the transform above it."""
+
+        ymin, ymax = self.y_extent
+        zmin, zmax = self.z_extent
+        r0, r1 = self.shader_radius
+
+        # The radius is linear in y, so it's largest at either end
+        rad = 0.0
+        for y in self.y_extent:
+            t = y / Y_SPACING + 0.5
+            r = r1 * t + r0 * (1 - t)
+            rad = max(rad, abs(r - zmin), abs(r - zmax))
+
+        far_y = max(0.0, self.y + ymax + BOUNDS_MARGIN - 10.0)
+        rad += self.bend_factor * far_y * far_y + BOUNDS_MARGIN
+
+        self.node_path.node().set_bounds(BoundingBox((-rad, ymin - BOUNDS_MARGIN, -rad), (rad, ymax + BOUNDS_MARGIN, rad)))
+
+    def in_fog(self):
+        "Returns True if the near edge of the ring is lost in the fog."
+
+        return self.y - Y_SPACING / 2.0 > self.fog_distance
+
     def needs_cull(self):
-        return self.node_path.get_y() < -Y_SPACING / 2.0 - CULL_MARGIN
+        return self.y < -Y_SPACING / 2.0 - CULL_MARGIN
+
+
+class RingPool:
+    "Recycles culled rings, along with their nodes and instance buffers."
+
+    def __init__(self, size, scroll):
+        self.size = size
+        self.scroll = scroll
+        self.free = [Ring(scroll) for i in range(size)]
+
+        # Rings are acquired by the generator thread, released by the main one
+        self.lock = threading.Lock()
+
+        self.start_time = time.monotonic()
+        self.reuses = 0
+        self.allocations = 0
+        self.discards = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                self.reuses += 1
+                return self.free.pop()
 
-    def advance(self, dy):
-        new_y = self.node_path.get_y() - dy
-        self.node_path.set_y(new_y)
-        if self.next_ring:
-            self.next_ring.advance(dy)
+            self.allocations += 1
+
+        return Ring(self.scroll)
+
+    def release(self, ring):
+        ring.node_path.detach_node()
+        ring.reset()
+
+        with self.lock:
+            if len(self.free) < self.size:
+                self.free.append(ring)
+            else:
+                self.discards += 1
+
+    @property
+    def allocations_per_minute(self):
+        minutes = (time.monotonic() - self.start_time) / 60.0
+        return self.allocations / minutes if minutes > 0 else 0.0
+
+    def __repr__(self):
+        return f"<RingPool {len(self.free)}/{self.size} free, {self.reuses} reuses, {self.allocations} allocations ({self.allocations_per_minute:.1f}/min), {self.discards} discards>"
 
 
 class Tube:
-    def __init__(self, model, seed=None):
+    def __init__(self, model, seed=None, num_rings=NUM_RINGS):
         self.root = NodePath("root")
         self.root.set_shader(shader)
-        self.root.set_shader_input('y', 0)
-        self.root.node().set_final(True)
-        self.root.node().set_bounds(OmniBoundingVolume())
+        self.root.set_shader_inputs(start_center=(0, 0), end_center=(0, 0))
         self.branch_root = self.root.attach_new_node("trunk")
-        self.branch_root.set_shader_inputs(start_center=(0, 0), end_center=(0, 0))
         self.random = Random(seed)
         self.y = 0
+        self.start_y = 0 # value of y at the start of the tube
+        self.render_y = 0 # where the tube is shown, see set_render_y
+        self.scroll_y = 0.0 # how far the rings have moved since the rebase
+        self.update_y_phase()
         self.first_ring = None
         self.last_ring = None
+        self.last_attached = None
         self.paused = False
+        self.num_rings = num_rings # how many rings ahead to have, up to NUM_RINGS
+        self.fogged_ring = None # first ring hidden by the fog, see show_rings
 
         self.music = MultiTrack()
         self.music.load_track('snare', 'assets/music/a/A-snare.ogg')
@@ -234,150 +654,145 @@ class Tube:
         self.music.load_track('drive', 'assets/music/b/B-drive.ogg')
         self.music.play()
 
-        self.next_level = 'steel'
-        self.next_tracks = set()
-
-        self.fog_factor = 0.04
-        self.twist_factor = 0.0
-        self.bend_time_factor = 0.0
-        self.bend_y_factor = 0.0
+        self.ring_pool = RingPool(NUM_RINGS + RETAINED_RINGS + RING_POOL_MARGIN, self.root)
+        self.retained_rings = deque()
+        self.ring_cache = RingCache(RING_CACHE_SIZE)
+        self.tile_nodes = {}
+        self.tile_profiles = {}
+        self.tile_emissive = {}
 
-        self.ts_steel = TileSet('steel')
-        self.ts_rift = TileSet('rift')
-        self.ts_flesh = TileSet('flesh')
-        self.ts_level = getattr(self, 'ts_' + LEVEL)
+        # Which maps the tube shader uses, see set_shading
+        self.normal_maps = True
+        self.emission_maps = True
 
         print("Processing segments...")
-        for n in model.children:
-            name = n.name
-            if name.startswith("steel_"):
-                self.ts_steel.add(n)
-            elif name.startswith("rift_"):
-                self.ts_rift.add(n)
-            elif name.startswith("flesh_"):
-                self.ts_flesh.add(n)
+        tilesets = make_tilesets(model)
+        self.ts_steel = tilesets['steel']
+        self.ts_rift = tilesets['rift']
+        self.ts_flesh = tilesets['flesh']
+
+        for ts in tilesets.values():
+            self.tile_nodes.update((n.name, n) for n, cnps in ts.tiles)
+            self.tile_profiles.update(ts.profiles)
+            self.tile_emissive.update(ts.emissive)
         print("Done.")
 
-        self.seg_count = 20
+        # The flat extents of all the tiles, for Ring.update_bounds
+        ymin = zmin = inf
+        ymax = zmax = -inf
+        for n in self.tile_nodes.values():
+            bounds = n.get_tight_bounds()
+            if bounds is not None:
+                ymin = min(ymin, bounds[0].y)
+                ymax = max(ymax, bounds[1].y)
+                zmin = min(zmin, bounds[0].z)
+                zmax = max(zmax, bounds[1].z)
+        self.tile_y_extent = (ymin, ymax)
+        self.tile_z_extent = (zmin, zmax)
+
+        # The layout only depends on the seed; self.random is for the rings
+        # that are made up on the fly, such as when rewinding
+        self.palette = TilePalette(tilesets)
+        self.layout = LayoutGenerator(self.palette, seed, extension_length=NUM_RINGS)
+
         self.next_emptyish = False
         self.generator = iter(self.gen_tube(LEVEL))
-        self.last_ring = next(self.generator)
-        self.first_ring = self.last_ring
+
+        # The generator only ever runs on this thread, after which the rings
+        # are handed to the main thread to be attached to the scene graph.
+        self.ring_queue = None
+        self.gen_thread = None
+        self.gen_stop = threading.Event()
+        if THREADED_GENERATION and Thread.is_threading_supported():
+            self.ring_queue = Queue(LOOKAHEAD_RINGS)
+            self.gen_thread = threading.Thread(target=self.gen_thread_func, name="ring_gen", daemon=True)
+            self.gen_thread.start()
+
+        self.first_ring = self.pull_ring()
         self.current_ring = self.first_ring
 
-        for i in range(NUM_RINGS):
-            if self.last_ring.branch_root == self.branch_root:
-                next(self.generator)
+        for i in range(self.num_rings):
+            if self.last_attached.branch_root == self.branch_root:
+                self.pull_ring()
 
     def destroy(self):
+        if self.gen_thread:
+            self.gen_stop.set()
+            self.gen_thread.join()
+            self.gen_thread = None
+
         self.music.set_playing_tracks(('space_big',))
         self.music.do_fade()
         self.music.stop()
         self.paused = True
+        self.release_retained_rings()
         self.root.remove_node()
+        self.ring_cache.clear()
 
-    def calc_types(self, count, allow_swervible, allow_passable=True, allow_tunnel=True):
-        exits = self.last_ring.exits
-        old_count = len(self.last_ring.collision_nodes)
-        if count > old_count and count / old_count == 3:
-            exits = [(exit[0] * 3, exit[1], exit[2]) for exit in exits]
-
-        elif old_count > count and old_count / count == 3:
-            old_exits = exits
-            exits = []
-            for old_exit in old_exits:
-                i = int(round(old_exit[0] / 3))
-                exits.append((i - 1, old_exit[1] + 1, old_exit[2]))
-                exits.append((i, old_exit[1], old_exit[2]))
-                exits.append((i + 1, old_exit[1], old_exit[2] + 1))
-
-        elif count != old_count:
-            if allow_tunnel and allow_passable:
-                return RingList(self.random.choices((NavType.PASSABLE, NavType.PASSABLE, NavType.TUNNEL)) * count)
-            elif allow_tunnel:
-                return RingList([NavType.TUNNEL] * count)
-            else:
-                return RingList([NavType.PASSABLE] * count)
-
-        # Slight chance of random passable tile
-        #types = RingList(self.random.choices((NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.PASSABLE)) * count)
-        types = RingList(self.random.choices((NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.IMPASSABLE, NavType.PASSABLE if allow_passable else NavType.TUNNEL)) * count)
 
-        for i, sw_left, sw_right in exits:
-            if types[i].is_passable:
-                continue
+    def gen_thread_func(self):
+        try:
+            for ring in self.generator:
+                if not self.put_from_thread(ring):
+                    return
+        except Exception as ex:
+            # Let the main thread raise it when it next needs a ring
+            self.put_from_thread(ex)
 
-            sw_next = (types[i] == NavType.SWERVIBLE)
+    def put_from_thread(self, item):
+        """Waits for room in the ring queue, but gives up (returning False) when
+        the tube is being destroyed, so that the thread can be joined."""
 
-            if (sw_next or sw_left) and types[i - 1] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+        while not self.gen_stop.is_set():
+            try:
+                self.ring_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
 
-            if (sw_next or sw_right) and types[i + 1] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+        return False
 
-            if sw_left and types[i - 1] == NavType.TUNNEL:
-                continue
-
-            if sw_right and types[i + 1] == NavType.TUNNEL:
-                continue
+    def pull_ring(self, block=True):
+        "Attaches the next generated ring, or returns None if none is ready."
 
-            if sw_left >= 2 and types[i - 2] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+        if self.ring_queue is None:
+            ring = next(self.generator)
+        else:
+            try:
+                ring = self.ring_queue.get(block)
+            except Empty:
+                return None
+            if isinstance(ring, Exception):
+                raise ring
+
+        self.attach_ring(ring)
+        return ring
 
-            if sw_right >= 2 and types[i + 2] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+    def attach_ring(self, ring):
+        prev_ring = self.last_attached
+        if prev_ring is not None:
+            prev_ring.next_ring = ring
+            ring.y = prev_ring.y + Y_SPACING
+        else:
+            ring.y = 0
 
-            if sw_left and sw_next and types[i - 1] == NavType.SWERVIBLE and types[i - 2] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+        if ring.inst_parent is not None and not ring.inst_parent.has_parent():
+            ring.inst_parent.reparent_to(self.root)
 
-            if sw_right and sw_next and types[i + 1] == NavType.SWERVIBLE and types[i + 2] in (NavType.PASSABLE, NavType.EMPTY):
-                continue
+        ring.node_path.reparent_to(ring.branch_root)
+        ring.node_path.set_shader(self.get_ring_shader(ring))
+        ring.update_bounds()
+        self.last_attached = ring
+        self.show_rings()
 
-            choices = []
-            if allow_swervible or allow_passable or sw_left:
-                choices.append(-1)
-            if allow_swervible or allow_passable or sw_right:
-                choices.append(1)
-            if sw_left and (allow_swervible or allow_passable):
-                choices.append(-2)
-            if sw_right and (allow_swervible or allow_passable):
-                choices.append(2)
-
-            choice = self.random.choice(choices) if choices else 0
-
-            if (choice < 0 and not sw_left) or (choice > 0 and not sw_right):
-                # To get to this one, need to swerve through the tile ahead
-                assert allow_swervible or allow_passable
-                if allow_swervible and types[i] != NavType.PASSABLE and types[i] != NavType.EMPTY:
-                    types[i] = NavType.SWERVIBLE
-                else:
-                    # we just have to make this one passable
-                    if types[i] != NavType.EMPTY:
-                        types[i] = NavType.PASSABLE
-                    continue
-                types[i + choice] = NavType.PASSABLE
-            else:
-                assert allow_tunnel or allow_passable
-                if allow_tunnel:
-                    types[i + choice] = NavType.TUNNEL
-                elif allow_passable:
-                    types[i + choice] = NavType.PASSABLE
-                else:
-                    types[i + choice] = NavType.EMPTY
-
-            if abs(choice) == 2:
-                # To get to this one, the one between it must also be swervible
-                assert allow_swervible or allow_passable
-                assert types[i + choice // 2] != NavType.TUNNEL
-                types[i + choice // 2] = NavType.SWERVIBLE
-
-        return types
+        # Get the music ready by the time we reach this ring
+        self.music.request_tracks(ring.play_tracks)
 
     @property
     def next_ring(self):
         ring = self.current_ring
         if ring.next_ring is None:
-            return next(self.generator)
+            return self.pull_ring()
         return ring.next_ring
 
     def resume(self):
@@ -386,13 +801,60 @@ class Tube:
     def pause(self):
         self.paused = True
 
+    def update_y_phase(self, y=None):
+        # Calculated here in double precision, since the shader can't keep up
+        # with the distance on long runs
+        y = (self.y if y is None else y) - self.start_y
+        self.root.set_shader_input('y_phase', (sin(y / 25), sin(y / 177), cos(y / 13), 0))
+
+    def set_render_y(self, y):
+        """Shows the tube as if it were at y, such as between two steps, without
+        affecting the simulation.  The next update() or set_y() undoes this."""
+
+        self.render_y = y
+        self.root.set_y(-(self.scroll_y + y - self.y))
+        self.update_y_phase(y)
+
+    def rebase(self):
+        "Shifts the origin back to the ship, so the coordinates stay small."
+
+        shift = self.scroll_y
+
+        ring = self.first_ring
+        while ring is not None:
+            ring.node_path.set_y(ring.node_path.get_y() - shift)
+            ring = ring.next_ring
+
+        for ring in self.retained_rings:
+            ring.node_path.set_y(ring.node_path.get_y() - shift)
+
+        self.scroll_y = 0.0
+        self.root.set_y(0)
+        self.y -= shift
+        self.start_y -= shift
+        self.render_y -= shift
+        messenger.send('tube-rebase', [shift])
+
     def set_y(self, y):
         dy = y - self.y
         self.y = y
-        self.root.set_shader_input('y', self.y)
-        self.first_ring.advance(dy)
+        self.render_y = y
+        self.update_y_phase()
+        self.scroll_y += dy
+        self.root.set_y(-self.scroll_y)
         while self.first_ring.y > -Y_SPACING:
-            ring = self.prepend_empty_ring()
+            if not self.restore_ring():
+                self.prepend_empty_ring()
+
+        if dy < 0:
+            # The rings moved away, so they may bend further out
+            self.update_bounds()
+
+    def update_bounds(self):
+        ring = self.first_ring
+        while ring is not None:
+            ring.update_bounds()
+            ring = ring.next_ring
 
     def update(self, dt):
         if self.paused:
@@ -400,13 +862,20 @@ class Tube:
 
         dy = dt * SPEED
         self.y += dy
+        self.render_y = self.y
 
-        if self.y == dy:
+        if self.y - dy == self.start_y:
             dy = 0
 
-        self.root.set_shader_input('y', self.y)
+        self.update_y_phase()
+        self.scroll_y += dy
+        self.root.set_y(-self.scroll_y)
+
+        if self.scroll_y > REBASE_DISTANCE:
+            self.rebase()
 
-        self.first_ring.advance(dy)
+        if self.fogged_ring is not None and not self.fogged_ring.in_fog():
+            self.show_rings()
 
         ring = self.first_ring
         while ring is not None:
@@ -417,442 +886,294 @@ class Tube:
                 self.music.set_playing_tracks(ring.play_tracks)
                 self.current_ring = ring
                 if self.branch_root != ring.branch_root:
+                    self.release_retained_rings()
                     ring.inst_parent.remove_node()
                     ring.branch_root.reparent_to(self.root)
                     self.branch_root.remove_node()
                     self.branch_root = ring.branch_root
-                    self.branch_root.set_shader_inputs(start_center=(0, 0), end_center=(0, 0))
                 break
             ring = ring.next_ring
 
         ring = self.first_ring
+        culled = False
         while ring and ring.needs_cull():
-            ring.node_path.remove_node()
-            ring = ring.next_ring
+            next_ring = ring.next_ring
+            self.retain_ring(ring)
+            ring = next_ring
             self.first_ring = ring
+            culled = True
+
+        if culled:
+            self.music.release_tracks(self.get_upcoming_tracks())
+            self.show_rings()
 
-        # Make sure we have NUM_RINGS.
+        # Make sure we have num_rings, or enough to reach into the fog.
         ring = self.first_ring
-        for i in range(NUM_RINGS):
+        for i in range(self.num_rings):
             if ring.branch_root != self.branch_root:
                 break
 
-            ring = ring.next_ring
-            if not ring:
-                ring = next(self.generator)
-
-                # generating one per frame is enough
+            if ring.next_ring is None:
+                if not ring.in_fog():
+                    # attaching one per frame is enough
+                    self.pull_ring(block=False)
                 break
 
-    def gen_tube(self, level):
-        if level == 'steel':
-            yield from self.gen_steel_level()
-
-        if level != 'flesh':
-            yield from self.gen_rift_level()
-
-        yield from self.gen_flesh_level()
-
-    def gen_steel_level(self):
-        self.fog_factor = 0.008
-        self.twist_factor = 0.0
-        self.bend_time_factor = 0.0
-        self.bend_y_factor = 0.0002
-        self.next_level = 'steel'
-
-        self.seg_count = 60
-        self.ts_level = self.ts_steel
-        self.next_tracks = set(['peace'])
-        yield self.gen_empty_ring()
-        yield from self.gen_obstacle_section()
-        yield from self.gen_wall_section(2)
-        yield from self.gen_tile_section(1)
-
-        yield from self.gen_trench()
-        self.next_tracks.add('peace')
-
-        yield self.gen_empty_ring(delta=10)
-        yield from self.gen_random_section()
-
-        self.next_tracks.add('space_big')
-        yield self.gen_empty_ring(delta=30)
-        yield self.gen_empty_ring(delta=60)
-        yield self.gen_empty_ring(delta=30)
-        yield from self.gen_random_section()
-        yield from self.gen_tile_section(3)
-        yield from self.gen_random_section()
-        yield from self.gen_random_section()
-        yield from self.gen_trench()
-        yield from self.gen_tile_section(1)
-        self.next_tracks.discard('space_big')
-        yield self.gen_passable_ring()
-        self.next_tracks.discard('peace')
-
-        self.next_tracks.add('tight')
-        yield from self.gen_transition(6)
-        yield from self.gen_wall_section()
-
-    def gen_rift_level(self):
-        self.fog_factor = 0.008
-        self.twist_factor = 0.0
-        self.bend_time_factor = 0.0
-        self.bend_y_factor = 0.0002
-        self.next_level = 'rift'
-
-        self.seg_count = 6
-        self.ts_level = self.ts_rift
-        self.next_tracks = set(['tight', 'medium'])
-        yield self.gen_empty_ring(delta=10)
-
-        yield self.gen_passable_ring(delta=3)
-        yield self.gen_passable_ring(delta=3)
-        yield self.gen_passable_ring(delta=3)
-        yield self.gen_passable_ring(delta=3)
-        yield self.gen_passable_ring(delta=3)
-        yield self.gen_passable_ring(delta=3)
-
-        yield from self.gen_trench()
-
-        self.next_tracks = set(['peace', 'drive'])
-
-        self.next_tracks.add('space_big')
-        yield self.gen_empty_ring(delta=30)
-        yield self.gen_empty_ring(delta=60)
-        yield self.gen_empty_ring(delta=30)
-        yield from self.gen_tile_section(3)
-        yield from self.gen_tile_section(1)
-        yield self.gen_empty_ring(delta=3)
-        yield from self.gen_trench(length=10)
-        self.next_tracks.discard('space_big')
-        yield self.gen_empty_ring()
-        self.next_tracks.discard('peace')
-
-        self.next_tracks.add('tight')
-        yield from self.gen_transition(12)
-        yield from self.gen_tile_section(1)
-        yield from self.gen_tile_section()
-        yield from self.gen_tile_section()
-
-    def gen_flesh_level(self):
-        # Always start with empty
-        self.next_level = 'flesh'
-        self.seg_count = 12
-        yield self.gen_empty_ring(ts=self.ts_rift)
-
-        self.next_tracks.discard('tight')
-        self.next_tracks.add('space')
-        self.next_tracks.add('drive')
-
-        self.fog_factor = 0.04
-        self.twist_factor = 5.0
-        self.bend_time_factor = 0.0003
-        self.bend_y_factor = 0.0002
-
-        ts = self.ts_flesh
-        self.ts_level = ts
-
-        # mouth... ewww
-        self.seg_count = 200
-        #yield self.gen_empty_ring()
-        gravity = 0.7
-        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 100, override_gravity=gravity)
-        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 40, override_gravity=gravity)
-        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 15, override_gravity=gravity)
-        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 6, override_gravity=gravity)
-        yield self.gen_ring([ts.segments[seg] for seg in ts.segments if 'obstacle' in seg and 'tile1' in seg] * 3, override_gravity=gravity)
-
-        self.next_tracks.discard('space')
-        self.next_tracks.discard('drive')
-        self.next_tracks.add('ambient')
-
-        ring = self.last_ring
-        ring.exits.append((self.random.randrange(0, 3), 0, 0))
-
-        #yield from self.gen_tile_section()
-        #yield from self.gen_tile_section()
-
-        # stomach or something ew
-        ring = self.gen_empty_ring(delta=-self.seg_count + 3, override_gravity=1)
-        ring.node_path.set_shader_input("radius", (ring.start_radius, 1))
-        yield ring
-        self.seg_count = 40
-        yield self.gen_empty_ring(override_gravity=1)
-        yield self.gen_passable_ring(override_gravity=1)
-        yield from self.gen_tile_section()
-        yield from self.gen_tile_section()
-        yield self.gen_passable_ring(delta=-3)
-        self.next_tracks.add('drive')
-        yield from self.gen_transition(6)
-
-        yield from self.gen_tile_section()
-        yield self.gen_passable_ring(delta=3)
-        yield from self.gen_tile_section()
-        yield self.gen_passable_ring(delta=-3)
-
-        yield self.gen_empty_ring(delta=100, override_gravity=0.0)
-        ring = self.gen_empty_ring()
-        ring.event = 'endgame'
-        yield ring
-
-        while True:
-            yield from self.gen_tile_section(override_gravity=0.0)
-
-    def gen_transition(self, to_segs, ts=None):
-        ts = ts or self.ts_level
-        transition_ts = self.ts_steel if ts is self.ts_rift else ts
-
-        seg1 = transition_ts.segments['tile1_transition']
-        seg2 = transition_ts.segments['tile1_transition_impassable']
-        segs = [seg1, seg2, seg2] * (int(ceil(self.seg_count // 3)))
-        ring = self.gen_ring(segs)
-        ring.end_depth = 3.0
-        yield ring
-
-        self.extend_ring_geometry(ring, NUM_RINGS, skip=1, ts=ts)
-
-        inst_parent = self.root.attach_new_node('branch')
-        branch_root = NodePath('branch')
+            ring = ring.next_ring
 
-        rad = (to_segs - len(segs)) / AR_FACTOR - 3
-        fac = tau / self.seg_count
-        for seg in range(self.seg_count):
-            if seg % 3 == 0:#types[seg].is_passable:
-                center = Vec2(-sin(seg * fac), cos(seg * fac)) * rad
-                inst = inst_parent.attach_new_node('inst')
-                branch_root.instance_to(inst)
-                inst.set_shader_inputs(start_center=center, end_center=center)
+    def get_ring_shader(self, ring):
+        return get_tube_shader(self.normal_maps, self.emission_maps and ring.emissive)
 
-        self.seg_count = to_segs
+    def set_shading(self, normal_maps, emission_maps):
+        "Switches the rings to the shader permutation that uses the given maps."
 
-        # Every tile after tunnel should be passable but not a tunnel
-        options = [transition_ts.segments[seg] for seg in transition_ts.segments if 'tile1_passable_gate' in seg or 'tile1_passable_obstacle' in seg]
-        segs = self.random.choices(options, k=to_segs)
-        ring = self.gen_ring(segs, inst_parent=inst_parent, branch_root=branch_root)
+        self.normal_maps = normal_maps
+        self.emission_maps = emission_maps
+        self.root.set_shader(get_tube_shader(normal_maps, emission_maps))
 
-        for i in range(to_segs):
-            ring.exits.append((i, 1, 1))
+        ring = self.first_ring
+        while ring is not None:
+            ring.node_path.set_shader(self.get_ring_shader(ring))
+            ring = ring.next_ring
 
-        yield ring
+        for ring in self.retained_rings:
+            ring.node_path.set_shader(self.get_ring_shader(ring))
 
-    def gen_random_section(self):
-        width = self.random.choice(('wall', 'obstacle', 1, 3))
-        if width == 'wall':
-            yield from self.gen_wall_section()
-        elif width == 'obstacle':
-            yield from self.gen_obstacle_section()
-        else:
-            yield from self.gen_tile_section(width)
+    def set_num_rings(self, num_rings):
+        "Changes how many rings ahead are kept around and shown."
 
-    def gen_tile_section(self, width=None, ts=None, override_gravity=None):
-        if width is None:
-            width = self.random.choice((1, 3))
+        self.num_rings = num_rings
+        self.show_rings()
 
-        ts = self.ts_level
+    def show_rings(self):
+        """Shows the first num_rings rings, up to the first one that is lost in
+        the fog, and hides the ones past that.  The fog only gets thicker
+        further along the tube, so the ones past that would be lost too."""
 
-        if len(ts.tile1_by_type[NavType.PASSABLE]) == 0:
-            width = 3
+        ring = self.first_ring
+        i = 0
+        shown = True
+        self.fogged_ring = None
+        while ring is not None:
+            if shown and i >= self.num_rings:
+                # Left over from when there were more
+                shown = False
+            elif shown and ring.in_fog():
+                shown = False
+                self.fogged_ring = ring
+
+            if shown:
+                ring.node_path.show()
+            else:
+                ring.node_path.hide()
+            ring = ring.next_ring
+            i += 1
 
-        count = int(ceil(self.seg_count / width))
-
-        tiles = ts.tile3_by_type if width == 3 else ts.tile1_by_type
-        allow_tunnel = len(tiles[NavType.TUNNEL]) > 0
-
-        for j in range(SECTION_LENGTH):
-            types = self.calc_types(count, allow_swervible=True, allow_tunnel=allow_tunnel)
-            segs = RingList(self.random.choice(tiles[next_type]) for next_type in types)
-
-            ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
-            ring.exits = []
-            for i in range(count):
-                if types[i] == NavType.TUNNEL:
-                    # Can't swerve out of a tunnel
-                    ring.exits.append((i, 0, 0))
-                elif types[i] == NavType.PASSABLE:
-                    ring.exits.append((i, types[i - 1] == NavType.PASSABLE, types[i + 1] == NavType.PASSABLE))
-            yield ring
-
-    def gen_obstacle_section(self, length=SECTION_LENGTH, ts=None):
-        ts = ts or self.ts_level
-        count = self.seg_count
-
-        for j in range(length):
-            types = self.calc_types(count, allow_swervible=True, allow_tunnel=False)
-
-            exits = []
-            segs = RingList()
-            for i, nt in enumerate(types):
-                if nt == NavType.IMPASSABLE or nt == NavType.SWERVIBLE:
-                    segs.append(ts.segments[self.random.choice(('tile1_passable_obstacle_3', 'tile1_passable_obstacle_4'))])
-                else:
-                    segs.append(ts.segments[self.random.choice(('tile1_empty', 'tile1_empty.001'))])
-                    exits.append((i, 2, 2))
-
-            ring = self.gen_ring(segs)
-            ring.exits = exits
-            yield ring
-
-    def gen_wall_section(self, length=SECTION_LENGTH, ts=None):
-        ts = ts or self.ts_level
-        count = self.seg_count
-
-        for j in range(length):
-            types = self.calc_types(count, allow_swervible=True, allow_tunnel=False)
-
-            exits = []
-            segs = RingList()
-            for i, nt in enumerate(types):
-                if nt == NavType.IMPASSABLE or nt == NavType.SWERVIBLE:
-                    segs.append(ts.segments['tile1_swervible_wall_1'])
-                elif nt == NavType.EMPTY or self.random.getrandbits(1):
-                    segs.append(ts.segments['tile1_empty'])
-                    exits.append((i, 4, 4))
-                else:
-                    segs.append(ts.segments['tile1_passable_gate_1'])
-                    exits.append((i, 4, 4))
-
-            ring = self.gen_ring(segs)
-            ring.exits = exits
-            yield ring
-
-    def gen_passable_ring(self, delta=0, ts=None, override_gravity=None):
-        ts = ts or self.ts_level
-
-        tiles = ts.tile1_by_type[NavType.PASSABLE]
-        width = 1
-        if not tiles:
-            tiles = ts.tile3_by_type[NavType.PASSABLE]
-            width = 3
+    def get_upcoming_tracks(self):
+        "Returns the music tracks that the rings we have may still play."
+
+        tracks = set()
+        for ring in self.retained_rings:
+            tracks.update(ring.play_tracks)
 
-        segs = self.random.choices(tiles, k=int(ceil((self.seg_count + delta) / width)))
-        ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
+        ring = self.first_ring
+        while ring is not None:
+            tracks.update(ring.play_tracks)
+            ring = ring.next_ring
+        return tracks
 
-        for i in range(len(segs)):
-            ring.exits.append((i, 1, 1))
+    def retain_ring(self, ring):
+        "Takes a culled ring out of the scene, keeping it around for rewinds."
 
-        return ring
+        ring.node_path.detach_node()
+        self.retained_rings.append(ring)
+        if len(self.retained_rings) > RETAINED_RINGS:
+            self.ring_pool.release(self.retained_rings.popleft())
 
-    def gen_empty_ring(self, delta=0, ts=None, override_gravity=None):
-        ts = ts or self.ts_level
+    def restore_ring(self):
+        """Puts the most recently culled ring back in front of the first ring.
+        Returns False if there is none left to put back."""
 
-        if ts.tile1_by_type[NavType.EMPTY]:
-            segs = self.random.choices(ts.tile1_by_type[NavType.EMPTY], k=max(1, self.seg_count + delta))
-            width = 1
-        else:
-            segs = self.random.choices(ts.tile3_by_type[NavType.EMPTY], k=int(ceil((self.seg_count + delta) / 3)))
-            width = 3
+        if not self.retained_rings:
+            return False
 
-        ring = self.gen_ring(segs, width=width, override_gravity=override_gravity)
+        ring = self.retained_rings.pop()
+        next_ring = self.first_ring
+        if ring.branch_root != next_ring.branch_root:
+            self.retained_rings.append(ring)
+            self.release_retained_rings()
+            return False
 
-        for i in range(len(segs)):
-            ring.exits.append((i, 4, 4))
+        ring.next_ring = next_ring
+        ring.y = next_ring.y - Y_SPACING
+        ring.node_path.reparent_to(ring.branch_root)
+        self.first_ring = ring
+        self.show_rings()
+        return True
 
-        return ring
+    def release_retained_rings(self):
+        while self.retained_rings:
+            self.ring_pool.release(self.retained_rings.popleft())
 
-    def gen_trench(self, length=SECTION_LENGTH, ts=None):
-        ts = ts or self.ts_level
+    def gen_tube(self, level):
+        for layout in self.layout.gen_tube(level):
+            yield self.build_ring(layout)
 
-        if not ts.entrance_trenches or not ts.middle_trenches:
-            return
+    @timed("Tube.build_ring")
+    def build_ring(self, layout):
+        "Constructs the nodes for a ring from its layout."
 
-        self.next_tracks.discard('peace')
-        self.next_tracks.discard('tight')
-        self.next_tracks.add('medium')
-
-        types = self.calc_types(self.seg_count // 3, allow_swervible=False, allow_passable=False, allow_tunnel=True)
-        exits = []
-        for i in range(len(types)):
-            if types[i] == NavType.TUNNEL:
-                exits.append((i, 0, 0))
-
-        segs = [self.random.choice(ts.entrance_trenches if nt == NavType.TUNNEL else ts.impassable_trenches) for nt in types]
-        ring = self.gen_ring(segs, width=3)
-        ring.exits = exits
-        ring.end_depth = TRENCH_DEPTH
-        yield ring
-
-        for i in range(length):
-            segs = [self.random.choice(ts.middle_trenches if nt == NavType.TUNNEL else ts.impassable_trenches) for nt in types]
-            ring = self.gen_ring(segs, width=3)
-            ring.exits = exits
-            ring.start_depth = TRENCH_DEPTH
-            ring.end_depth = TRENCH_DEPTH
-            yield ring
-
-        self.next_tracks.discard('medium')
-        self.next_tracks.add('peace')
-
-        if ts.exit_trenches:
-            segs = [self.random.choice(ts.exit_trenches if nt == NavType.TUNNEL else ts.impassable_trenches) for nt in types]
-            ring = self.gen_ring(segs, width=3)
-            ring.exits = exits
-            ring.start_depth = TRENCH_DEPTH
-            yield ring
-
-    def gen_ring(self, set, width=1, parent=None, inst_parent=None, branch_root=None, override_gravity=None):
-        count = len(set) * width
+        segs = [self.palette.tiles[id] for id in layout.tiles]
+        count = layout.count
         assert count > 0
 
-        from_radius = self.seg_count / AR_FACTOR
+        from_radius = layout.start_count / AR_FACTOR
         to_radius = count / AR_FACTOR
 
-        if parent is None:
-            parent = self.last_ring
-
-        if branch_root is None:
+        if layout.branch:
+            inst_parent, branch_root = self.make_branch(self.last_ring, count)
+        else:
+            inst_parent = None
             branch_root = self.last_ring.branch_root if self.last_ring else self.branch_root
 
-        ring = Ring()
+        ring = self.ring_pool.acquire()
         ring.num_segments = count
         ring.start_radius = from_radius
         ring.end_radius = to_radius
-        ring.x_spacing = X_SPACING * width
+        ring.start_depth = layout.start_depth
+        ring.end_depth = layout.end_depth
+        ring.x_spacing = X_SPACING * layout.width
         ring.inst_parent = inst_parent
         ring.branch_root = branch_root
-        ring.play_tracks = tuple(self.next_tracks)
-        ring.level = self.next_level
-        ring.override_gravity = override_gravity
-
-        np = NodePath("ring")
-        np.node().set_final(True)
-        ring.node_path = np
+        ring.play_tracks = layout.play_tracks
+        ring.level = layout.level
+        ring.override_gravity = layout.override_gravity
+        ring.event = layout.event
 
+        np = ring.node_path
         ring.r_to_x = count * X_SPACING
 
-        for c, (gnode, cnodes) in enumerate(set):
-            gnode = gnode.copy_to(np)
-            gnode.set_pos(c * X_SPACING * width, 0, 0)
+        for gnode, cnodes in segs:
             ring.collision_nodes.append(cnodes)
+            ring.collision_profiles.append(self.tile_profiles[gnode.name])
+            ring.emissive = ring.emissive or self.tile_emissive[gnode.name]
 
-        np.flatten_strong()
-        np.set_y(parent.node_path.get_y() + Y_SPACING if parent else 0)
-        np.reparent_to(ring.branch_root)
+        self.set_ring_geometry(ring, segs, layout.width)
+
+        if layout.extension is not None:
+            rows = [[self.palette.tiles[id] for id in row] for row in layout.extension]
+            ring.extension = self.get_ring_geometry(rows, skip=layout.extension_skip).instance_to(np)
+            ring.emissive = ring.emissive or any(self.tile_emissive[gnode.name] for row in rows for gnode, cnodes in row)
+
+        ymin, ymax = self.tile_y_extent
+        if layout.extension is not None:
+            ymax += (len(layout.extension) - 1 + layout.extension_skip) * Y_SPACING
+        ring.shader_radius = (from_radius, to_radius if layout.shader_end_radius is None else layout.shader_end_radius)
+        ring.y_extent = (ymin, ymax)
+        ring.z_extent = self.tile_z_extent
+        ring.bend_factor = 2 * abs(layout.level_params[2]) + abs(layout.level_params[3])
 
         np.set_shader_inputs(
             num_segments=count,
-            radius=(from_radius, to_radius),
-            level_params=(self.fog_factor, self.twist_factor, self.bend_time_factor, self.bend_y_factor),
+            radius=ring.shader_radius,
+            level_params=layout.level_params,
         )
+        ring.fog_distance = fog_cull_distance(layout.level_params[0])
 
-        if parent is not None:
-            parent.next_ring = ring
-        if parent is self.last_ring:
-            self.last_ring = ring
-
-        self.seg_count = count
+        # Not linked up yet; the main thread does that in attach_ring
+        self.last_ring = ring
         return ring
 
-    def extend_ring_geometry(self, last_ring, num_extra_rings, skip, ts):
-        np = last_ring.node_path.attach_new_node("ring_extension")
-        width = 1
+    def make_branch(self, prev_ring, to_segs):
+        """Returns the nodes for a tube that branches off each third segment
+        of prev_ring, as an (inst_parent, branch_root) pair."""
+
+        # Gets attached to the root by attach_ring
+        inst_parent = NodePath('branch')
+        branch_root = NodePath('branch')
+
+        seg_count = prev_ring.num_segments
+        rad = (to_segs - seg_count) / AR_FACTOR - 3
+        fac = tau / seg_count
+        for seg in range(seg_count):
+            if seg % 3 == 0:#types[seg].is_passable:
+                # tube.vert offsets the tube by the position, which lets each
+                # instance be culled by its own bounds
+                center = Vec2(-sin(seg * fac), cos(seg * fac)) * rad
+                inst = inst_parent.attach_new_node('inst')
+                branch_root.instance_to(inst)
+                inst.set_pos(center.x, 0, center.y)
+
+        return inst_parent, branch_root
+
+    def set_ring_geometry(self, ring, segs, width=1):
+        "Replaces the ring's geometry, reusing its existing nodes and buffers."
+
+        if not INSTANCED_TILES:
+            if ring.geom is not None:
+                ring.geom.detach_node()
+            ring.geom = self.get_ring_geometry([segs], width).instance_to(ring.node_path)
+            return
+
+        offsets = defaultdict(list)
+        for c, (gnode, cnodes) in enumerate(segs):
+            offsets[gnode.name] += (c * X_SPACING * width, 0)
 
-        for i in range(num_extra_rings):
-            segs = self.random.choices([ts.segments[seg] for seg in ts.segments if 'tile1' in seg], k=last_ring.num_segments)
+        for name, (np, inst_array) in ring.tile_geoms.items():
+            if name not in offsets:
+                np.stash()
 
+        for name, tile_offsets in offsets.items():
+            if name in ring.tile_geoms:
+                np, inst_array = ring.tile_geoms[name]
+                np.unstash()
+                write_instance_offsets(np, inst_array, tile_offsets)
+            else:
+                np = self.get_tile_template(name).copy_to(ring.node_path)
+                ring.tile_geoms[name] = (np, set_instance_offsets(np, tile_offsets))
+
+    def get_ring_geometry(self, rows, width=1, skip=0):
+        "Returns flattened geometry for rows of segments."
+
+        if INSTANCED_TILES:
+            return self.get_instanced_geometry(rows, width, skip)
+
+        geom = NodePath("ring_geom")
+        for i, segs in enumerate(rows):
             for c, (gnode, cnodes) in enumerate(segs):
-                gnode = gnode.copy_to(np)
+                gnode = gnode.copy_to(geom)
                 gnode.set_pos(c * X_SPACING * width, (i + skip) * Y_SPACING, 0)
 
-        np.flatten_strong()
+        geom.flatten_strong()
+        clear_geom_bounds(geom)
+        return geom
+
+    def get_tile_template(self, name):
+        """Returns the instancing template of the named tile, which every ring
+        that has the tile copies, making it when it's first needed."""
+
+        # The tile names are prefixed with the name of their tileset
+        template = self.ring_cache.get(name)
+        if template is None:
+            template = make_instance_template(self.tile_nodes[name])
+            clear_geom_bounds(template)
+            self.ring_cache.put(name, template)
+        return template
+
+    def get_instanced_geometry(self, rows, width=1, skip=0):
+        "Like get_ring_geometry, but only builds a buffer of tile offsets."
+
+        offsets = defaultdict(list)
+        for i, segs in enumerate(rows):
+            for c, (gnode, cnodes) in enumerate(segs):
+                offsets[gnode.name] += (c * X_SPACING * width, (i + skip) * Y_SPACING)
+
+        geom = NodePath("ring_geom")
+        for name, tile_offsets in offsets.items():
+            inst = self.get_tile_template(name).copy_to(geom)
+            set_instance_offsets(inst, tile_offsets)
+
+        return geom
 
     def prepend_empty_ring(self):
         next_ring = self.first_ring
@@ -868,7 +1189,7 @@ class Tube:
             width = 3
             segs = self.random.choices(ts.tile3_by_type[NavType.EMPTY], k=int(ceil((count) / 3)))
 
-        ring = Ring()
+        ring = self.ring_pool.acquire()
         ring.next_ring = next_ring
         ring.num_segments = count
         ring.start_radius = radius
@@ -880,26 +1201,31 @@ class Tube:
         ring.level = level
         ring.override_gravity = False
 
-        np = NodePath("ring")
-        np.node().set_final(True)
-        ring.node_path = np
-
+        np = ring.node_path
         ring.r_to_x = count * X_SPACING
 
-        for c, (gnode, cnodes) in enumerate(segs):
-            gnode = gnode.copy_to(np)
-            gnode.set_pos(c * X_SPACING * width, 0, 0)
+        for gnode, cnodes in segs:
             ring.collision_nodes.append(cnodes)
+            ring.collision_profiles.append(self.tile_profiles[gnode.name])
+            ring.emissive = ring.emissive or self.tile_emissive[gnode.name]
 
-        np.flatten_strong()
-        np.set_y(next_ring.y - Y_SPACING)
+        self.set_ring_geometry(ring, segs, width)
+        ring.y = next_ring.y - Y_SPACING
         np.reparent_to(ring.branch_root)
 
         np.set_attrib(next_ring.node_path.get_attrib(ShaderAttrib))
+        np.set_shader(self.get_ring_shader(ring))
+        ring.fog_distance = next_ring.fog_distance
+        ring.shader_radius = (radius, radius)
+        ring.y_extent = self.tile_y_extent
+        ring.z_extent = self.tile_z_extent
+        ring.bend_factor = next_ring.bend_factor
+        ring.update_bounds()
         np.set_shader_inputs(
             num_segments=count,
-            radius=(radius, radius),
+            radius=ring.shader_radius,
         )
 
         self.first_ring = ring
+        self.show_rings()
         return ring